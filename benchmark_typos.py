@@ -0,0 +1,203 @@
+#!/usr/bin/python
+"""
+Script measuring how fast typo rules fix pages.
+
+It runs offline: the rules are loaded from benchmark/typos.wiki and
+the pages from benchmark/corpus.xml, a site stub provides what the
+rules need. Results of runs on different commits are comparable as
+long as the same pages and rules are used.
+
+Supported parameters:
+* -fix - apply the rules through TypoFix instead of one after another
+* -limit:# - how many pages to take from the dump (all by default)
+* -output: - file to append the result to as one JSON line
+* -repeat:# - how many times to go through the pages
+* -rules: - file with the typo rules
+* -xml: - dump to take the pages from instead of the corpus
+"""
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from unittest import mock
+
+import pywikibot
+
+from pywikibot.xmlreader import XmlDump
+
+from typoloader import TyposLoader
+from typowatchdog import TypoQuarantine
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'benchmark')
+
+
+class OfflineFamily:
+
+    obsolete = {}
+
+
+class OfflineSite:
+
+    '''Site stub providing what textlib needs for the typo exceptions'''
+
+    code = 'cs'
+    family = OfflineFamily()
+    namespaces = {
+        6: ['Soubor', 'Obrázek', 'File', 'Image'],
+        14: ['Kategorie', 'Category'],
+    }
+
+    def getmagicwords(self, word):
+        return [word]
+
+    def validLanguageLinks(self):
+        return ['de', 'en', 'pl', 'sk']
+
+    def __str__(self):
+        return 'wikipedia:cs'
+
+
+class OfflinePage:
+
+    '''Page stub holding its text'''
+
+    latest_revision_id = 0
+
+    def __init__(self, title, text=''):
+        self._title = title
+        self.text = text
+
+    def title(self, **kwargs):
+        return self._title
+
+    def exists(self):
+        return bool(self.text)
+
+
+class OfflineTyposLoader(TyposLoader):
+
+    '''Loader of typo rules from a local file'''
+
+    def __init__(self, site, *, path, **kwargs):
+        kwargs.setdefault('quarantine', TypoQuarantine(
+            os.path.join(tempfile.mkdtemp(), 'quarantine.json')))
+        super().__init__(site, cache=False, **kwargs)
+        self.path = path
+
+    def getTyposPage(self):
+        with open(self.path, encoding='utf-8') as file:
+            return OfflinePage(self.path, file.read())
+
+    def getWhitelistPage(self):
+        return OfflinePage('')
+
+
+def load_pages(path, limit=None):
+    pages = []
+    for entry in XmlDump(path).parse():
+        if entry.ns != '0' or entry.isredirect:
+            continue
+        pages.append((entry.title, entry.text))
+        if limit and len(pages) >= limit:
+            break
+    return pages
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            check=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+            text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = max(0, -(-len(values) * percent // 100) - 1)
+    return values[index] if values else 0.0
+
+
+def run(pages, rules_path, *, fix=False, repeat=1):
+    site = OfflineSite()
+    start = time.perf_counter()
+    if fix:
+        from custome_fixes import TypoFix
+
+        loader = lambda site: OfflineTyposLoader(site, path=rules_path)
+        with mock.patch('custome_fixes.TyposLoader', loader):
+            typo_fix = TypoFix(typosbudget=0)
+            typo_fix.site = site
+        rules = typo_fix.typoRules
+    else:
+        rules = OfflineTyposLoader(site, path=rules_path).loadTypos()
+    load_time = time.perf_counter() - start
+
+    latencies = []
+    changed = 0
+    for _ in range(repeat):
+        for title, text in pages:
+            page = OfflinePage(title, text)
+            start = time.perf_counter()
+            if fix:
+                typo_fix.apply(page, [])
+            else:
+                replaced = []
+                for rule in rules:
+                    if not rule.find.search(title):
+                        page.text = rule.apply(page.text, replaced)
+            latencies.append(time.perf_counter() - start)
+            changed += page.text != text
+
+    elapsed = sum(latencies)
+    return {
+        'commit': current_commit(),
+        'mode': 'fix' if fix else 'rules',
+        'pages': len(latencies),
+        'rules': len(rules),
+        'changed': changed,
+        'load': round(load_time, 4),
+        'elapsed': round(elapsed, 4),
+        'pages_per_sec': round(len(latencies) / elapsed, 2),
+        'rules_per_sec': round(len(latencies) * len(rules) / elapsed, 2),
+        'p95': round(percentile(latencies, 95), 6),
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def main(*args):
+    options = {
+        'fix': False,
+        'limit': None,
+        'output': None,
+        'repeat': 1,
+        'rules': os.path.join(BENCHMARK_DIR, 'typos.wiki'),
+        'xml': os.path.join(BENCHMARK_DIR, 'corpus.xml'),
+    }
+    # no pywikibot.handle_args, it must not need a configured site
+    for arg in args or sys.argv[1:]:
+        if arg.startswith('-'):
+            arg, sep, value = arg.partition(':')
+            if value != '':
+                options[arg[1:]] = int(value) if value.isdigit() else value
+            else:
+                options[arg[1:]] = True
+
+    pages = load_pages(options['xml'], options['limit'])
+    result = run(pages, options['rules'], fix=options['fix'],
+                 repeat=options['repeat'])
+    for key, value in result.items():
+        pywikibot.info(f'{key}: {value}')
+    if options['output']:
+        with open(options['output'], 'a', encoding='utf-8') as file:
+            file.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,27 @@
 #!/usr/bin/python
+import multiprocessing
+import os
+import queue
 import re
+import threading
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 import pywikibot
 
-from pywikibot import pagegenerators
-from pywikibot.exceptions import UnknownExtension
+from mwparserfromhell.parser import ParserError
+from pywikibot import config, pagegenerators
+from pywikibot.exceptions import InvalidTitleError, UnknownExtension
+from pywikibot.tools.itertools import itergroup
+from pywikibot.xmlreader import XmlDump
 
 from checkwiki_errors import *
+from checkwiki_reporter import CheckWikiReporter
+from regex_backends import backend_of, count_backends
+from tools import fork_context
 from wikitext import WikitextFixingBot
+from wikitext_document import get_view
 
 
 class CheckWikiSettings:
@@ -89,24 +103,137 @@ class CheckWikiSettings:
 
 class CheckWikiErrorGenerator:
 
-    def __init__(self, checkwiki, priorities=None, ids=None):
+    '''
+    Generator of pages listed for CheckWiki errors
+
+    Lists of several errors are streamed concurrently while the pages
+    are yielded in the order of the errors. Numbers of the errors a page
+    is listed for are collected under its title in checkwiki.listed
+    until the page is treated. A page is yielded again only if it is
+    listed for another error after it was treated.
+    '''
+
+    def __init__(self, checkwiki, priorities=None, ids=None, workers=4,
+                 buffer=1000):
         self.checkwiki = checkwiki
         self.priorities = priorities or []
         self.ids = ids or []
+        self.workers = workers
+        self.buffer = buffer
 
-    def __iter__(self):
-        for error in self.ids:
-            yield from self.checkwiki.iter_pages(error)
+    def iter_numbers(self):
+        yield from self.ids
         already = set(self.ids)
         for prio in self.priorities:
             for error in self.checkwiki.settings.get_errors_by_priority(prio):
                 if error not in already:
-                    yield from self.checkwiki.iter_pages(error)
+                    already.add(error)
+                    yield error
+
+    def fetch(self, number, titles, listed, stopped):
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    titles.put(item, timeout=1)
+                except queue.Full:
+                    continue
+                return True
+            return False
+
+        try:
+            for title in self.checkwiki.iter_titles(number):
+                listed.setdefault(title, set()).add(number)
+                if not put(title):
+                    return
+        finally:
+            put(None)
+
+    def __iter__(self):
+        listed = {}
+        handed = {}  # title -> numbers the page was yielded for
+        stopped = threading.Event()
+        executor = ThreadPoolExecutor(self.workers)
+        streams = []
+        try:
+            # the pool starts the fetches in this order, so the one
+            # being read is always running
+            for number in self.iter_numbers():
+                titles = queue.Queue(self.buffer)
+                future = executor.submit(
+                    self.fetch, number, titles, listed, stopped)
+                streams.append((number, future, titles))
+            for number, future, titles in streams:
+                while (title := titles.get()) is not None:
+                    numbers = handed.setdefault(title, set())
+                    if number in numbers:
+                        continue
+                    # the list of this error may not have been read
+                    # when the page was yielded for another error
+                    new = listed[title] - numbers
+                    numbers |= new
+                    page = pywikibot.Page(self.checkwiki.site, title)
+                    pending = self.checkwiki.listed.get(page.title())
+                    if pending is not None:
+                        # not treated yet, it will be fixed at once
+                        pending |= new
+                        continue
+                    self.checkwiki.listed[page.title()] = new
+                    yield page
+                future.result()
+        finally:
+            stopped.set()
+            for _, future, _ in streams:
+                future.cancel()
+            executor.shutdown()
+
+
+class CheckWikiFixPlan:
+
+    '''
+    Order in which CheckWiki errors are fixed
+
+    Errors are sorted topologically so that each of them comes after
+    the errors listed in its needsFirst. Otherwise, they keep their
+    order.
+    '''
+
+    def __init__(self, errors):
+        errors = list(errors)
+        by_number = {error.number: error for error in errors}
+        self.order = []
+        done = set()
+        visiting = []
+
+        def visit(error):
+            if error.number in done:
+                return
+            if error.number in visiting:
+                cycle = visiting[visiting.index(error.number):]
+                cycle.append(error.number)
+                raise ValueError('Cyclic needsFirst of CheckWiki errors: '
+                                 + ' -> '.join(map(str, cycle)))
+            visiting.append(error.number)
+            for number in error.needsFirst:
+                if number in by_number:
+                    visit(by_number[number])
+            visiting.pop()
+            done.add(error.number)
+            self.order.append(error)
+
+        for error in errors:
+            visit(error)
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.order)
 
 
 class CheckWiki:
 
     url = 'https://tools.wmflabs.org/checkwiki/cgi-bin/checkwiki_bots.cgi'
+    document = None  # WikitextDocument of the page, set by CheckWikiFix
 
     errorMap = {
         1: PrefixedTemplate,
@@ -156,11 +283,19 @@ class CheckWiki:
         104: ReferenceQuotes,
     }
 
-    def __init__(self, site):
+    def __init__(self, site, lists=None):
+        self.checked = Counter()
+        self.skipped = Counter()
+        self.lists = lists  # directory with lists made by detect_dump
+        self.reporter = None
+        self.listed = {}  # filled by CheckWikiErrorGenerator
+        self._session = None
         self.site = site
 
     def purge(self):
         self.__cache = {}
+        self.__patterns = {}
+        self.__plans = {}
 
     @property
     def site(self):
@@ -171,6 +306,8 @@ class CheckWiki:
         self._site = value
         self.purge()
         self.load_settings()
+        self.compile_patterns()
+        self.get_plan()  # fail early on cyclic dependencies
 
     def load_settings(self):
         pywikibot.info('Loading CheckWiki settings...')
@@ -183,7 +320,26 @@ class CheckWiki:
         return self._settings
 
     def get_error(self, number):
-        return self.__cache.setdefault(number, self.errorMap[number](self))
+        if number not in self.__cache:
+            self.__cache[number] = self.errorMap[number](self)
+        return self.__cache[number]
+
+    def get_pattern(self, error):
+        '''Return the pattern of the error compiled for the current site'''
+        if error.number not in self.__patterns:
+            self.__patterns[error.number] = error.pattern()
+        return self.__patterns[error.number]
+
+    def compile_patterns(self):
+        for error in self.iter_errors():
+            if hasattr(error, 'pattern'):
+                self.get_pattern(error)
+        backends = count_backends(
+            backend_of(regex) for regex in self.__patterns.values())
+        summary = ', '.join(f'{count} on {backend}'
+                            for backend, count in sorted(backends.items()))
+        pywikibot.info(
+            f'{len(self.__patterns)} CheckWiki patterns compiled ({summary})')
 
     def iter_errors(self, numbers=None, only_for_fixes=False, priorities=None):
         for num in self.errorMap:
@@ -198,21 +354,22 @@ class CheckWiki:
 
             yield error
 
-    def apply(self, text, page, replaced=[], fixed=[], errors=[], **kwargs):
-        # todo: use a graph algorithm
-        errors = list(self.iter_errors(set(errors)))
-        while errors:
-            error = errors.pop(0)
-            if error.needsDecision() or error.handledByCC():  # todo
-                continue
+    def get_plan(self, numbers=None):
+        '''Return the order of fixing the errors, all of them by default'''
+        key = frozenset(numbers or ())
+        if key not in self.__plans:
+            self.__plans[key] = CheckWikiFixPlan(
+                error for error in self.iter_errors(key)
+                # todo
+                if not error.needsDecision() and not error.handledByCC())
+        return self.__plans[key]
 
-            numbers = [err.number for err in errors]
-            i = max([numbers.index(num) for num in error.needsFirst
-                     if num in numbers] + [0])
-            if i > 0:
-                errors.insert(i, error)
+    def apply(self, text, page, replaced=[], fixed=[], errors=[], **kwargs):
+        for error in self.get_plan(errors):
+            self.checked[error.number] += 1
+            if not error.precheck(text):
+                self.skipped[error.number] += 1
                 continue
-
             new_text = error.apply(text, page)
             if new_text != text:
                 text = new_text
@@ -223,37 +380,106 @@ class CheckWiki:
 
         return text
 
+    def get_view(self, view, text):
+        '''Return the view of the text, shared with the fixes if possible'''
+        return get_view(self.document, view, text, self.site)
+
+    def detect(self, text, page, numbers=None):
+        '''Return spans of the errors in the text by their numbers'''
+        found = {}
+        for error in self.iter_errors(numbers):
+            spans = error.detect(text, page)
+            if spans:
+                found[error.number] = spans
+        return found
+
+    def report_prechecks(self):
+        '''Print how many times each error was skipped by its precheck'''
+        if not self.checked:
+            return
+        pywikibot.info('Skipped by prechecks:')
+        for number, checked in sorted(self.checked.items()):
+            skipped = self.skipped[number]
+            pywikibot.info(
+                f'{number:>3}: {skipped}/{checked} ({skipped / checked:.0%})')
+
+    def list_path(self, num):
+        return os.path.join(self.lists, f'{num}.txt')
+
+    def read_list(self, num):
+        try:
+            with open(self.list_path(num), encoding='utf-8') as file:
+                for line in file:
+                    yield line.rstrip('\n')
+        except FileNotFoundError:
+            return
+
     def iter_titles(self, num, **kwargs):
-        data = {
-            'action': 'list',
-            'id': num,
-            'project': self.site.dbName(),
-        }
-        for line in self.get(data, **kwargs).iter_lines():
-            yield line.decode().replace('title=', '')  # fixme: b/c
+        if self.lists:
+            lines = self.read_list(num)
+        else:
+            data = {
+                'action': 'list',
+                'id': num,
+                'project': self.site.dbName(),
+            }
+            kwargs.setdefault('stream', True)
+            lines = (line.decode()
+                     for line in self.get(data, **kwargs).iter_lines())
+        for line in lines:
+            yield line.replace('title=', '')  # fixme: b/c
 
     def iter_pages(self, num, **kwargs):
         for title in self.iter_titles(num, **kwargs):
             yield pywikibot.Page(self.site, title)
 
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = requests.Session()
+        return self._session
+
     def get(self, data, **kwargs):
-        return requests.get(self.url, data, **kwargs)
+        return self.session.get(self.url, params=data, **kwargs)
 
     def post(self, data, **kwargs):
-        return requests.post(self.url, data, **kwargs)
+        return self.session.post(self.url, data, **kwargs)
 
-    def mark_as_fixed(self, page, error):
-        data = {
+    @staticmethod
+    def mark_data(page, error):
+        return {
             'action': 'mark',
             'id': error,
             'project': page.site.dbName(),
             'title': page.title(),
         }
-        return self.post(data)
+
+    def mark_as_fixed(self, page, error):
+        if self.lists:
+            return None  # the lists are made again from the next dump
+        return self.post(self.mark_data(page, error))
+
+    def get_reporter(self):
+        if self.reporter is None:
+            self.reporter = CheckWikiReporter(
+                self.url, config.datafilepath('checkwiki-marks.jsonl'))
+        return self.reporter
 
     def mark_as_fixed_multiple(self, page, errors):
+        '''Mark the errors as fixed in the background'''
+        if self.lists or not errors:
+            return
+        reporter = self.get_reporter()
         for error in errors:
-            self.mark_as_fixed(page, error)
+            reporter.mark(self.mark_data(page, error))
+
+    def close(self):
+        '''Wait until the marks are sent and close the connections'''
+        if self.reporter is not None:
+            self.reporter.close()
+        if self._session is not None:
+            self._session.close()
+            self._session = None
 
     @staticmethod
     def parse_option(option):
@@ -275,12 +501,24 @@ class CheckWikiBot(WikitextFixingBot):
         self.checkwiki = checkwiki
         self.numbers = numbers
 
+    def skip_page(self, page):
+        skip = super().skip_page(page)
+        if skip:
+            # not treated, so a later listing yields it again
+            self.checkwiki.listed.pop(page.title(), None)
+        return skip
+
     def treat_page(self):
         page = self.current_page
         replaced = []
         fixed = []
+        numbers = self.numbers
+        listed = self.checkwiki.listed.pop(page.title(), set())
+        if numbers:
+            # fix all errors the page was listed for in one edit
+            numbers = sorted(set(numbers) | listed)
         text = self.checkwiki.apply(
-            page.text, page, replaced, fixed, self.numbers)
+            page.text, page, replaced, fixed, numbers)
         summary = f"opravy dle [[WP:WCW|CheckWiki]]: {', '.join(replaced)}"
         self.put_current(
             text, summary=summary,
@@ -291,6 +529,73 @@ class CheckWikiBot(WikitextFixingBot):
             return
         self.checkwiki.mark_as_fixed_multiple(page, numbers)
 
+    def teardown(self):
+        self.checkwiki.report_prechecks()
+        self.checkwiki.close()
+        super().teardown()
+
+
+_dump_state = {}  # set in each worker process
+
+
+def _init_dump_worker(checkwiki, numbers):
+    _dump_state.update(checkwiki=checkwiki, numbers=numbers)
+
+
+def _detect_dump_entry(entry):
+    title, text = entry
+    checkwiki = _dump_state['checkwiki']
+    page = pywikibot.Page(checkwiki.site, title)
+    try:
+        found = checkwiki.detect(text, page, _dump_state['numbers'])
+    except (InvalidTitleError, ParserError) as exc:
+        # wikitext which cannot be parsed
+        pywikibot.error(f'{title}: {exc!r}')
+        found = {}
+    return title, {number: len(spans) for number, spans in found.items()}
+
+
+def detect_dump(checkwiki, xml, numbers=None, processes=None, batch=200):
+    '''
+    Find CheckWiki errors in a local XML dump without fixing them
+
+    Titles of pages having each error are written to its own file in
+    checkwiki.lists, in the format of the CheckWiki service. CheckWiki
+    with the same lists then reads them instead of the service.
+
+    Worker processes are forked, see tools.fork_context().
+    '''
+    os.makedirs(checkwiki.lists, exist_ok=True)
+    entries = ((entry.title, entry.text)
+               for entry in XmlDump(xml).parse()
+               if entry.ns == '0' and not entry.isredirect)
+    files = {}
+    pages = Counter()
+    occurrences = Counter()
+    processes = processes or multiprocessing.cpu_count()
+    try:
+        with fork_context().Pool(
+                processes, initializer=_init_dump_worker,
+                initargs=(checkwiki, numbers)) as pool:
+            # bounded batches keep the memory flat
+            for group in itergroup(entries, batch * processes):
+                for title, found in pool.imap(_detect_dump_entry, group, 8):
+                    for number, count in found.items():
+                        if number not in files:
+                            files[number] = open(checkwiki.list_path(number),
+                                                 'w', encoding='utf-8')
+                        files[number].write(f'title={title}\n')
+                        pages[number] += 1
+                        occurrences[number] += count
+    finally:
+        for file in files.values():
+            file.close()
+
+    for number in sorted(pages):
+        pywikibot.info(f'{number:>3}: {pages[number]} pages, '
+                       f'{occurrences[number]} occurrences')
+    return pages
+
 
 def main(*args):
     options = {}
@@ -300,6 +605,7 @@ def main(*args):
     genFactory = pagegenerators.GeneratorFactory(site=site)
     numbers = []
     gens = []
+    paths = ('lists', 'xml')  # strings even if they look like numbers
     for arg in genFactory.handle_args(local_args):
         if arg.startswith('-checkwiki:'):
             ids, priorities = checkwiki.parse_option(arg.partition(':')[2])
@@ -309,13 +615,33 @@ def main(*args):
             continue
         if arg.startswith('-'):
             arg, sep, value = arg.partition(':')
-            if value != '':
-                options[arg[1:]] = int(value) if value.isdigit() else value
-            else:
+            if value == '':
                 options[arg[1:]] = True
+            elif value.isdigit() and arg[1:] not in paths:
+                options[arg[1:]] = int(value)
+            else:
+                options[arg[1:]] = value
         else:
             numbers.extend(checkwiki.parse_option(arg)[0])
 
+    checkwiki.lists = options.pop('lists', None)
+    xml = options.pop('xml', None)
+    processes = options.pop('processes', None)
+    if checkwiki.lists is True or xml is True:
+        pywikibot.error('-lists and -xml need a path, e.g. -lists:<directory>')
+        return
+    if xml:
+        if not checkwiki.lists:
+            pywikibot.error('Scanning a dump needs -lists:<directory> '
+                            'to write the lists to')
+            return
+        if fork_context() is None:
+            pywikibot.error('Scanning a dump needs to fork worker '
+                            'processes, which this platform cannot do')
+            return
+        detect_dump(checkwiki, xml, numbers, processes)
+        return
+
     if gens:
         genFactory.gens.extend(gens)
     generator = genFactory.getCombinedGenerator(preload=True)
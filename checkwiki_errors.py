@@ -5,7 +5,11 @@ import pywikibot
 
 from pywikibot import textlib
 
+from protected_regions import find_except, replace_except
+from references import ReferenceIndex
+from regex_backends import compile_pattern
 from tools import deduplicate
+from wikitext_document import header_regex
 
 
 class CheckWikiError:
@@ -15,10 +19,16 @@ class CheckWikiError:
     exceptions = ['ce', 'comment', 'graph', 'hiero', 'math', 'nowiki', 'pre',
                   'score', 'startspace', 'syntaxhighlight']
     needsFirst = []
+    required = ()  # strings one of which the text must contain
 
     def __init__(self, checkwiki):
         self.checkwiki = checkwiki
 
+    def precheck(self, text):
+        '''Return False if the error cannot be in the text'''
+        return not self.required or any(
+            string in text for string in self.required)
+
     @property
     def site(self):
         return self.checkwiki.site
@@ -28,15 +38,42 @@ class CheckWikiError:
         return self.checkwiki.settings
 
     def apply(self, text, page):
-        return textlib.replaceExcept(text, self.pattern(), self.replacement,
-                                     self.exceptions, site=page.site)
+        return replace_except(text, self.get_pattern(), self.replacement,
+                              self.exceptions, site=page.site)
+
+    def detect(self, text, page):
+        '''
+        Return spans of occurrences of the error in the text
+
+        Nothing is fixed. Errors with their own apply() find them by
+        their own spans().
+        '''
+        if not self.precheck(text):
+            return []
+        return self.spans(text, page)
+
+    def spans(self, text, page):
+        '''Return spans of matches of the pattern which would be fixed'''
+        if not self.isForFixes():
+            return []
+        return [match.span() for match in find_except(
+            text, self.get_pattern(), self.replacement, self.exceptions,
+            site=page.site)]
+
+    def get_pattern(self):
+        '''Return the pattern compiled once for the current site'''
+        return self.checkwiki.get_pattern(self)
+
+    def get_view(self, view, text):
+        '''Return the view of the text, shared with the fixes if possible'''
+        return self.checkwiki.get_view(view, text)
 
     def isForFixes(self):  # todo: per subclass
         return hasattr(self, 'pattern') and hasattr(self, 'replacement')
 
     def toTuple(self):
         assert self.isForFixes()
-        return (self.pattern().pattern, self.replacement)
+        return (self.get_pattern().pattern, self.replacement)
 
     def needsDecision(self):  # todo: per subclass, user_interactor
         return False
@@ -53,30 +90,34 @@ class CCHandledError(CheckWikiError):
 
 class HeaderError(CheckWikiError):
 
+    required = ('=',)
     summary = 'oprava nadpisu'
 
     def pattern(self):
-        return re.compile('(?m)^(?P<start>==+)(?P<content>((?!==|= *$).)+?)(?P<end>==+) *$')
+        # the same as the headers view of WikitextDocument
+        return compile_pattern(header_regex.pattern, re.M)
 
 
 class TagReplacement(CheckWikiError):
 
+    required = ('<',)
     summary = 'odstranění zb. HTML tagu'
     tag = None  # extend
 
     def pattern(self):
         # fixme
-        return re.compile(r'(?s)<(?P<tag>%s)>(?P<content>.*?)</(?P=tag)>')
+        return compile_pattern(r'(?s)<(?P<tag>%s)>(?P<content>.*?)</(?P=tag)>')
 
 
 class EntityReplacement(CheckWikiError):
 
+    required = ('&',)
     entities_map = {}
     #needsFirst = [87]
     summary = 'substituce HTML entity'
 
     def pattern(self):
-        return re.compile(f"&(?P<entity>{'|'.join(self.entities_map.keys())});")
+        return compile_pattern(f"&(?P<entity>{'|'.join(self.entities_map.keys())});")
 
     def replacement(self, match):
         entity = match['entity']
@@ -85,16 +126,18 @@ class EntityReplacement(CheckWikiError):
 
 class DefaultsortError(CheckWikiError):
 
+    required = ('{{',)
     summary = 'oprava DEFAULTSORTu'
 
     def pattern(self):
         magic = self.site.getmagicwords('defaultsort')
-        return re.compile(r'\{\{ *(?P<magic>%s)(?P<key>[^}]+)\}\}'
-                          % '|'.join(magic))
+        return compile_pattern(r'\{\{ *(?P<magic>%s)(?P<key>[^}]+)\}\}'
+                               % '|'.join(magic))
 
 
 class PrefixedTemplate(CheckWikiError):
 
+    required = ('{{',)
     number = 1
     summary = 'odstranění prefixu šablony'
 
@@ -102,70 +145,110 @@ class PrefixedTemplate(CheckWikiError):
         namespaces = self.site.namespaces[10]
         patterns = [textlib.case_escape(namespaces.case, ns) for ns in namespaces]
         pattern = '|'.join(patterns)
-        return re.compile(r'\{\{ *(%s) *: *' % pattern)
+        return compile_pattern(r'\{\{ *(%s) *: *' % pattern)
 
     def replacement(self, match):
         return '{{'
 
 
+class TagPositions:
+
+    '''
+    Positions of opening and closing tags found in one pass over text
+
+    Queries must come with non-decreasing positions, each of them then
+    takes amortized constant time.
+    '''
+
+    def __init__(self, text, tag):
+        regex = re.compile(f'<{tag}(?: (?P<params>[^>]+))?(?<!/)>')
+        self.opening = [match.end() for match in regex.finditer(text)]
+        closing = f'</{tag}>'
+        self.closing = []  # (start, end)
+        index = text.find(closing)
+        while index >= 0:
+            self.closing.append((index, index + len(closing)))
+            index = text.find(closing, index + len(closing))
+        self.opened = self.closed = 0  # how many end before the position
+
+    def last_opening(self, pos):
+        '''Return end of the last opening tag ending before pos or None'''
+        while (self.opened < len(self.opening)
+               and self.opening[self.opened] <= pos):
+            self.opened += 1
+        return self.opening[self.opened - 1] if self.opened else None
+
+    def closed_between(self, start, pos):
+        '''Return whether a closing tag is between start and pos'''
+        while (self.closed < len(self.closing)
+               and self.closing[self.closed][1] <= pos):
+            self.closed += 1
+        return self.closed > 0 and self.closing[self.closed - 1][0] >= start
+
+
 class BrokenHTMLTag(CheckWikiError):
 
+    required = ('<',)
     number = 2
     summary = 'oprava chybné syntaxe HTML tagu'
     tags = ('abbr', 'b', 'big', 'blockquote', 'center', 'cite', 'del', 'div',
             'em', 'font', 'i', 'p', 's', 'small', 'span', 'strike', 'sub',
             'sup', 'table', 'td', 'th', 'tr', 'tt', 'u')
+    param_regex = re.compile(
+        '(?P<param>[a-z]+) *= *'
+        '(?P<quote>[\'"])?'
+        r'(?P<content>(?(quote)(?!(?P=quote)|>).|\w)+)'
+        '(?(quote)(?P=quote)|)')
 
     def pattern(self):
-        return re.compile(r'< */+ *([bh]r)[ /]*>')
+        return compile_pattern(r'< */+ *([bh]r)[ /]*>')
 
     def replacement(self, match):
         return match.expand(r'<\1 />')
 
-    def apply(self, text, page):
-        param_regex = re.compile(
-            '(?P<param>[a-z]+) *= *'
-            '(?P<quote>[\'"])?'
-            r'(?P<content>(?(quote)(?!(?P=quote)|>).|\w)+)'
-            '(?(quote)(?P=quote)|)')
-
-        def replaceTag(match):
-            tag = match['tag']
-            if match.group('params') is not None:
-                params = []
-                for p in param_regex.finditer(match.group('params')):
-                    params.append(p.group('param', 'content'))
-                if len(params) == 1:
-                    if params[0][0] == 'id':
-                        return '{{Kotva|%s}}' % params[0][1]  # fixme: l10n
-                    if params[0][0] in ('clear', 'style'):
-                        for s in ('right', 'left'):
-                            if s in params[0][1]:
-                                return '{{Clear|%s}}' % s # fixme: l10n from settings
-                        return '{{Clear}}'
+    def get_tag_regex(self):
+        return re.compile(
+            f"<(?P<tag>{'|'.join(self.tags)})(?: (?P<params>[^>]+?))? */>")
 
-            else:
-                tags_before = list(
-                    re.finditer(f'<{tag}(?: (?P<params>[^>]+))?(?<!/)>',
-                                match.string[:match.start()])
-                    )
-                if tags_before:
-                    last = tags_before[-1]
-                    if f'</{tag}>' not in match.string[last.end():match.start()]:
-                        return f'</{tag}>'
-                else:
-                    return ''
+    def replace_tag(self, match, positions):
+        tag = match['tag']
+        if match.group('params') is not None:
+            params = []
+            for p in self.param_regex.finditer(match.group('params')):
+                params.append(p.group('param', 'content'))
+            if len(params) == 1:
+                if params[0][0] == 'id':
+                    return '{{Kotva|%s}}' % params[0][1]  # fixme: l10n
+                if params[0][0] in ('clear', 'style'):
+                    for s in ('right', 'left'):
+                        if s in params[0][1]:
+                            return '{{Clear|%s}}' % s # fixme: l10n from settings
+                    return '{{Clear}}'
 
-            return match.group()
+        else:
+            if tag not in positions:
+                positions[tag] = TagPositions(match.string, tag)
+            last = positions[tag].last_opening(match.start())
+            if last is not None:
+                if not positions[tag].closed_between(last, match.start()):
+                    return f'</{tag}>'
+            else:
+                return ''
 
-        text = re.sub(
-            f"<(?P<tag>{'|'.join(self.tags)})(?: (?P<params>[^>]+?))? */>",
-            replaceTag,
-            text,
-        )
+        return match.group()
 
+    def apply(self, text, page):
+        positions = {}
+        text = self.get_tag_regex().sub(
+            lambda match: self.replace_tag(match, positions), text)
         return super().apply(text, page)
 
+    def spans(self, text, page):
+        positions = {}
+        spans = [match.span() for match in self.get_tag_regex().finditer(text)
+                 if self.replace_tag(match, positions) != match.group()]
+        return sorted(spans + super().spans(text, page))
+
 
 class LowHeadersLevel(HeaderError):
 
@@ -173,17 +256,21 @@ class LowHeadersLevel(HeaderError):
     needsFirst = [8]
     summary = 'oprava úrovní nadpisů'
 
-    def apply(self, text, page):
-        regex = self.pattern()
+    def min_level(self, text):
+        '''Return the lowest level of headers or None if any is broken'''
         min_level = 8
-        for match in regex.finditer(text):
+        for match in self.get_view('headers', text):
             start, end = match.group('start', 'end')
             if len(start) == len(end):
                 min_level = min(min_level, len(start))
             else:
-                return text
+                return None
+        return min_level
 
-        if min_level > 2:
+    def apply(self, text, page):
+        regex = self.get_pattern()
+        min_level = self.min_level(text)
+        if min_level is not None and min_level > 2:
             text = regex.sub(
                 lambda match: '{eq} {content} {eq}'.format(
                     eq=match['start'][min_level-2:],
@@ -192,14 +279,21 @@ class LowHeadersLevel(HeaderError):
 
         return text
 
+    def spans(self, text, page):
+        min_level = self.min_level(text)
+        if min_level is None or min_level <= 2:
+            return []
+        return [match.span() for match in self.get_view('headers', text)]
+
 
 class MissingEquation(CheckWikiError):
 
+    required = ('=',)
     number = 8
     summary = 'oprava úrovně nadpisů'
 
     def pattern(self):
-        return re.compile(
+        return compile_pattern(
             '(?m)^(?P<start>=+)(?P<content>.+?)(?P<end>(?: *=+)*) *$')
 
     def replacement(self, match):
@@ -222,6 +316,7 @@ class SingleLineCategories(CCHandledError):
 
 class NoEndSquareBrackets(CheckWikiError): # fixme
 
+    required = ('[[',)
     exceptions = list(set(CheckWikiError.exceptions) - {'startspace'})
     needsFirst = [86, 103]
     number = 10
@@ -229,8 +324,8 @@ class NoEndSquareBrackets(CheckWikiError): # fixme
     tags = ('pre', 'ref')
 
     def pattern(self):
-        return re.compile(r'(?i)\[\[(?P<inside>(?:(?!\[\[|\]\]|<(?:%s)[ >]).)*)'
-                          r'(?P<after>\[\[|\]\])?' % '|'.join(self.tags))
+        return compile_pattern(r'(?i)\[\[(?P<inside>(?:(?!\[\[|\]\]|<(?:%s)[ >]).)*)'
+                               r'(?P<after>\[\[|\]\])?' % '|'.join(self.tags))
 
     def replacement(self, match):
         inside, after = match.group('inside', 'after')
@@ -339,7 +434,7 @@ class HTMLEntity(EntityReplacement):
     number = 11
 
     def pattern(self):
-        return re.compile('&(?P<entity>[A-Za-z0-9]+);')
+        return compile_pattern('&(?P<entity>[A-Za-z0-9]+);')
 
     def replacement(self, match):
         entity = match['entity']
@@ -359,6 +454,7 @@ class InvisibleChars(CCHandledError):
 
 class DuplicateCategory(CheckWikiError):
 
+    required = ('[[',)
     needsFirst = [21]
     number = 17
     summary = 'odstranění duplicitní kategorie'
@@ -370,6 +466,17 @@ class DuplicateCategory(CheckWikiError):
             text = textlib.replaceCategoryLinks(text, categories, page.site)
         return text
 
+    def spans(self, text, page):
+        categories = textlib.getCategoryLinks(text)
+        if len(categories) == len(set(categories)):
+            return []
+        # all the links are put together again from the first one
+        regex = re.compile(r'\[\[\s*(?:%s)\s*:' % '|'.join(
+            map(re.escape, page.site.namespaces[14])), re.I)
+        match = regex.search(text)
+        start = match.start() if match else 0
+        return [(start, start)]
+
 
 class LowerCaseCategory(CCHandledError):
 
@@ -383,7 +490,7 @@ class SingleEquationHeader(HeaderError):
     summary = 'oprava úrovně nadpisu'
 
     def pattern(self):
-        return re.compile(r'(?m)^=([^\n=]+)= *$')
+        return compile_pattern(r'(?m)^=([^\n=]+)= *$')
 
     def replacement(self, match):
         return f'== {match[1].strip()} =='
@@ -404,7 +511,7 @@ class EnglishCategory(CCHandledError):
     summary = 'počeštění jmenného prostoru'
 
     def pattern(self):
-        return re.compile(r'\[\[ *[Cc]ategory *: *')
+        return compile_pattern(r'\[\[ *[Cc]ategory *: *')
 
     def replacement(self, match):
         ns = list(self.site.namespaces[14])
@@ -414,6 +521,7 @@ class EnglishCategory(CCHandledError):
 
 class CategoryWithSpace(CheckWikiError):
 
+    required = ('[[',)
     number = 22
     summary = 'odstranění bílých znaků z kategorie'
 
@@ -450,13 +558,13 @@ class HeaderHierarchy(HeaderError):
     number = 25
     summary = 'oprava úrovně nadpisu'
 
-    def apply(self, text, page):
-        regex = self.pattern()
+    def fixed_levels(self, matches):
+        '''Return fixed levels of the headers or None if any is broken'''
         levels = []
-        for match in regex.finditer(text):
+        for match in matches:
             level = len(match['start'])
             if level != len(match['end']):
-                return text
+                return None
             levels.append(level)
 
         count = len(levels)
@@ -473,6 +581,14 @@ class HeaderHierarchy(HeaderError):
                 levels[i+1:index] = [x - 1 for x in levels[i+1:index]]
             i = index
 
+        return levels
+
+    def apply(self, text, page):
+        regex = self.get_pattern()
+        levels = self.fixed_levels(self.get_view('headers', text))
+        if levels is None:
+            return text
+
         i = 0
         pos = 0
         while True:
@@ -490,6 +606,14 @@ class HeaderHierarchy(HeaderError):
 
         return text
 
+    def spans(self, text, page):
+        matches = self.get_view('headers', text)
+        levels = self.fixed_levels(matches)
+        if levels is None:
+            return []
+        return [match.span() for match, level in zip(matches, levels)
+                if len(match['start']) != level]
+
 
 class Bold(CCHandledError, TagReplacement):
 
@@ -508,12 +632,13 @@ class Unicode(CheckWikiError): # todo
 
 class MultiplePipes(CheckWikiError):
 
+    required = ('[[',)
     needsFirst = [103]
     number = 32
     summary = 'oprava odkazu'
 
     def pattern(self):
-        return re.compile(r'\[\[([^|[:]+\|[^]|[]*\|[^][]*)\]\]')
+        return compile_pattern(r'\[\[([^|[:]+\|[^]|[]*\|[^][]*)\]\]')
 
     def replacement(self, match):
         split = [x.strip() for x in match.group(1).split('|')]
@@ -534,6 +659,7 @@ class MultiplePipes(CheckWikiError):
 
 class MagicWords(CheckWikiError):
 
+    required = ('{{',)
     exceptions = CheckWikiError.exceptions[:] + ['gallery', 'ref'] # todo: etc.
     magic_templates = (
         'fullpagename', 'sitename', 'namespace', 'basepagename', 'pagename',
@@ -542,7 +668,7 @@ class MagicWords(CheckWikiError):
     summary = 'odstranění kouzelných slov'
 
     def pattern(self):
-        return re.compile(r'(?:\{\{([^}|]+)\}\}|\{\{\{[^}]+\}\}\})')
+        return compile_pattern(r'(?:\{\{([^}|]+)\}\}|\{\{\{[^}]+\}\}\})')
 
     def replacement(self, match):
         text = match.group()
@@ -577,6 +703,7 @@ class StrikedText(TagReplacement):
 
 class BoldHeader(HeaderError):
 
+    required = ("'''",)
     #needsFirst = [26]
     number = 44
     summary = 'odtučnění nadpisu'
@@ -591,6 +718,7 @@ class BoldHeader(HeaderError):
 
 class SelfLink(CheckWikiError):
 
+    required = ('[[',)
     needsFirst = [103]
     number = 48
     summary = 'odstranění odkazu na sebe'
@@ -611,13 +739,24 @@ class SelfLink(CheckWikiError):
             return f"'''{split[-1]}'''" if index < 0 or match.end() < index else split[-1]
         return match.group()
 
-    def apply(self, text, page):
-        exceptions = list(set(self.exceptions + [
+    link_regex = re.compile(
+        r"(?P<before>''')?\[\[(?P<inside>[^]]+)\]\](?P<after>''')?")
+
+    def get_exceptions(self):
+        return list(set(self.exceptions + [
             'imagemap', 'includeonly', 'timeline']) - {'startspace'})
+
+    def apply(self, text, page):
         title = page.title()
-        return textlib.replaceExcept(
-            text, r"(?P<before>''')?\[\[(?P<inside>[^]]+)\]\](?P<after>''')?",
-            lambda m: self.replacement(m, title), exceptions, site=page.site)
+        return replace_except(
+            text, self.link_regex, lambda m: self.replacement(m, title),
+            self.get_exceptions(), site=page.site)
+
+    def spans(self, text, page):
+        title = page.title()
+        return [match.span() for match in find_except(
+            text, self.link_regex, lambda m: self.replacement(m, title),
+            self.get_exceptions(), site=page.site)]
 
 
 class HTMLHeader(CCHandledError):
@@ -651,12 +790,13 @@ class InterwikiBeforeCategory(CCHandledError):
 
 class ListWithBreak(CheckWikiError):
 
+    required = ('<',)
     list_chars = ':*#'
     number = 54
     summary = 'odstranění zb. zalomení'
 
     def pattern(self):
-        return re.compile(f'(?m)^[{self.list_chars}]+.*$')
+        return compile_pattern(f'(?m)^[{self.list_chars}]+.*$')
 
     def replacement(self, match):
         line = match.group()
@@ -685,6 +825,7 @@ class HeaderWithColon(HeaderError):
 
 class ParameterWithBreak(CheckWikiError):
 
+    required = ('<',)
     number = 59
     regex = re.compile(r'(?: *<[ /]*br[ /]*> *)+(?P<after>\s*)$')
     summary = 'odstranění zb. zalomení'
@@ -715,24 +856,46 @@ class ParameterWithBreak(CheckWikiError):
 
         return match.group()
 
+    def has_break(self, text):
+        '''Return whether any template parameter ends with a break'''
+        return any(self.regex.search(value)
+                   for _, params in self.get_view('templates', text)
+                   for value in params.values())
+
     def apply(self, text, page):
+        if not self.has_break(text):
+            return text
         return textlib.NESTED_TEMPLATE_REGEX.sub(self.replacement, text)
 
+    def spans(self, text, page):
+        if not self.has_break(text):
+            return []
+        return [match.span()
+                for match in textlib.NESTED_TEMPLATE_REGEX.finditer(text)
+                if self.replacement(match) != match.group()]
+
 
 class RefBeforePunctuation(CheckWikiError):
 
+    required = ('<ref',)
     number = 61
     punct = '.,:;'
     summary = 'oprava interpunkce'
 
     # note that this is in general very controversial "error"
     # this algorithm only fixes punctuation when it's both before and after reference
+    def get_ref_regex(self):
+        return re.compile('[%s]+ *(?:<ref(?= |>)[^>]*'
+                          '(?: ?/|>(?:(?!</?ref).)+</ref)>[%s ]*)+' % (
+                              self.punct, self.punct),
+                          re.S)
+
     def apply(self, text, page):
-        ref_regex = re.compile('[%s]+ *(?:<ref(?= |>)[^>]*'
-                               '(?: ?/|>(?:(?!</?ref).)+</ref)>[%s ]*)+' % (
-                                   self.punct, self.punct),
-                               re.S)
-        return ref_regex.sub(self.replacement, text)
+        return self.get_ref_regex().sub(self.replacement, text)
+
+    def spans(self, text, page):
+        return [match.span() for match in self.get_ref_regex().finditer(text)
+                if self.replacement(match) != match.group()]
 
     def replacement(self, match):
         if match.group().startswith(';') and match.string[match.start()-1] == '\n':
@@ -781,15 +944,16 @@ class RefBeforePunctuation(CheckWikiError):
 
 class SmallInsideTags(CheckWikiError):
 
+    required = ('small>',)
     number = 63
     summary = 'oprava zmenšení textu uvnitř jiných značek'
     tags = ('ref', 'sub', 'sup')
 
     def pattern(self):
-        return re.compile('<(?P<tag>%s)(?P<params> [^>]*)?>'
-                          '(?P<content>(?:(?!</(?P=tag)>).)*?'
-                          '</?small>(?:(?!</(?P=tag)>).)*?)'
-                          '</(?P=tag)>' % '|'.join(self.tags))
+        return compile_pattern('<(?P<tag>%s)(?P<params> [^>]*)?>'
+                               '(?P<content>(?:(?!</(?P=tag)>).)*?'
+                               '</?small>(?:(?!</(?P=tag)>).)*?)'
+                               '</(?P=tag)>' % '|'.join(self.tags))
 
     def replacement(self, match):
         content = match.group('content')
@@ -854,6 +1018,14 @@ class BadListStructure(CheckWikiError):  # todo
             text, regex, lambda match: self.replace(match, levels),
             self.exceptions[:], site=self.site)
 
+    def spans(self, text, page):
+        # replacements keep the lines, so each one is found in both texts
+        levels = ['']
+        regex = re.compile('^.*$', re.M)
+        return [match.span() for match in find_except(
+            text, regex, lambda match: self.replace(match, levels),
+            self.exceptions, site=self.site)]
+
 
 class NoSpace(CheckWikiError): # todo
 
@@ -862,12 +1034,13 @@ class NoSpace(CheckWikiError): # todo
 
 class BrokenExternalLink(CheckWikiError): # todo
 
+    required = ('[http',)
     number = 80
     summary = 'oprava externího odkazu'
 
     def pattern(self):
-        return re.compile(r'\[(?P<link>https?://[^][\n<]+)'
-                          r'(?P<stop>\]|</?ref|\n|\[)')
+        return compile_pattern(r'\[(?P<link>https?://[^][\n<]+)'
+                               r'(?P<stop>\]|</?ref|\n|\[)')
 
     def replacement(self, match):
         link, stop = match.group('link', 'stop')
@@ -885,24 +1058,22 @@ class BrokenExternalLink(CheckWikiError): # todo
 
 class DuplicateReferences(CheckWikiError):
 
+    required = ('<ref',)
     # fixme: we don't know what this could cause
     exceptions = CheckWikiError.exceptions[:] + ['references']
     needsFirst = [104]
     number = 81
     summary = 'oprava duplicitních referencí'
 
-    def apply(self, text, page):
-        ref_regex = re.compile(
-            '<ref(?= |>)(?P<params>[^>]*)'
-            '(?: ?/|>(?P<content>(?:(?!</?ref).)+)</ref)>',
-            re.S)
-
-        param_regex = re.compile(
-            '(?P<param>[a-z]+) *= *'
-            '(?P<quote>[\'"])?'
-            r'(?P<content>(?(quote)(?!(?P=quote)|>).|[\w-])+)'
-            '(?(quote)(?P=quote)|)')
+    def rewriters(self, text):
+        '''
+        Return the index of references in the text and two functions
+        rewriting them: the first one merges duplicates, the second one
+        repairs names and tidies the text made by the first one
+        '''
+        param_regex = ReferenceIndex.param_regex
 
+        # per group: content -> names in order, content -> name
         named_contents = {}
         duplicate_named_contents = {}
         unnamed_contents = {}
@@ -911,24 +1082,21 @@ class DuplicateReferences(CheckWikiError):
         destroyed_names = {}
         i = {}
 
-        def getParams(params):
-            name = ''
-            group = ''
-            for match in param_regex.finditer(params):
-                if match.group('param') == 'group':
-                    group = match.group('content').strip()
-                elif match.group('param') == 'name':
-                    name = match.group('content').strip()
-            return (name, group)
-
-        for match in ref_regex.finditer(text):
-            if match.group('content') is None:
+        def short_ref(name, group):
+            return '<ref name="%s"%s />' % (
+                name,
+                f' group="{group}"' if group != '' else '',
+            )
+
+        index = ReferenceIndex(text)
+        for ref in index:
+            if ref.content is None:
                 continue
-            content = match.group('content').strip()
-            name, group = getParams(match.group('params'))
+            content = ref.content
+            name, group = ref.name or '', ref.group
 
-            named_contents.setdefault(group, [])
-            duplicate_named_contents.setdefault(group, set())
+            named_contents.setdefault(group, {})
+            duplicate_named_contents.setdefault(group, {})
             unnamed_contents.setdefault(group, set())
             duplicate_unnamed_contents.setdefault(group, set())
             names.setdefault(group, set())
@@ -942,52 +1110,40 @@ class DuplicateReferences(CheckWikiError):
                     unnamed_contents[group].add(content)
             else:
                 names[group].add(name)
-                if (name, content) not in named_contents[group]:
-                    named_contents[group].append(
-                        (name, content)
-                    )
+                named_contents[group].setdefault(content, {})[name] = None
 
-        def replaceRef(match):
-            if match.group('content') is None:
-                return match.group()
+        def replaceRef(ref):
+            if ref.content is None:
+                return ref.text
 
-            content = match.group('content').strip()
-            name, group = getParams(match.group('params'))
+            content = ref.content
+            name, group = ref.name or '', ref.group
+            ref_names = named_contents[group].get(content)
             if name != '':
                 if name in destroyed_names[group]:
-                    return match.group() # do in the second round
-
-                for ref_name, ref_content in duplicate_named_contents[group]:
-                    if ref_content == content:
-                        if ref_name != name:
-                            destroyed_names[group][name] = ref_name
-                        return '<ref name="%s"%s />' % (
-                            ref_name,
-                            f' group="{group}"' if group != '' else '',
-                        )
-
-                for ref_name, ref_content in named_contents[group]:
-                    if ref_content == content:
-                        if ref_name == name:
-                            named_contents[group].remove(
-                                (name, content)
-                            )
-                            duplicate_named_contents[group].add(
-                                (name, content)
-                            )
-                        else:
-                            destroyed_names[group][name] = ref_name
-                        return match.group()
+                    return ref.text  # do in the second round
+
+                ref_name = duplicate_named_contents[group].get(content)
+                if ref_name is not None:
+                    if ref_name != name:
+                        destroyed_names[group][name] = ref_name
+                    return short_ref(ref_name, group)
+
+                if ref_names:
+                    ref_name = next(iter(ref_names))
                     if ref_name == name:
-                        pass # fixme: this should not happen!
+                        del ref_names[name]
+                        duplicate_named_contents[group][content] = name
+                    else:
+                        destroyed_names[group][name] = ref_name
+                    return ref.text
 
             else:
-                for ref_name, ref_content in named_contents[group] + list(duplicate_named_contents[group]):
-                    if ref_content == content:
-                        return '<ref name="%s"%s />' % (
-                            ref_name,
-                            f' group="{group}"' if group != '' else '',
-                        )
+                if ref_names:
+                    return short_ref(next(iter(ref_names)), group)
+                if content in duplicate_named_contents[group]:
+                    return short_ref(
+                        duplicate_named_contents[group][content], group)
 
                 if content in duplicate_unnamed_contents[group]:
                     new_name = f'rfr{i[group]}'
@@ -995,20 +1151,18 @@ class DuplicateReferences(CheckWikiError):
                         i[group] += 1
                         new_name = f'rfr{i[group]}'
                     names[group].add(new_name)
-                    duplicate_named_contents[group].add(
-                        (new_name, content)
-                    )
+                    duplicate_named_contents[group][content] = new_name
                     return '<ref name="%s"%s>%s</ref>' % (
                         new_name,
                         f' group="{group}"' if group != '' else '',
                         content,
                     )
 
-            return match.group()
+            return ref.text
 
-        def repairNamesAndTidy(match):
-            content, params = match.group('content', 'params')
-            name, group = getParams(params)
+        def repairNamesAndTidy(ref):
+            content, params = ref.match.group('content', 'params')
+            name, group = ref.name or '', ref.group
             if name.isdigit() and name not in destroyed_names[group]:
                 new_name = f'rfr{i[group]}'
                 while new_name in names[group]:
@@ -1031,14 +1185,25 @@ class DuplicateReferences(CheckWikiError):
                 ref += f' {param}={quote}{param_content}{quote}'
             return f'{ref}>{content.strip()}</ref>' if content is not None else f'{ref} />'
 
-        new_text = ref_regex.sub(replaceRef, text)
+        return index, replaceRef, repairNamesAndTidy
+
+    def apply(self, text, page):
+        index, replaceRef, repairNamesAndTidy = self.rewriters(text)
+        new_text = index.sub(replaceRef)
         if new_text != text:
-            text = ref_regex.sub(repairNamesAndTidy, new_text)
+            text = ReferenceIndex(new_text).sub(repairNamesAndTidy)
         return text
 
+    def spans(self, text, page):
+        # names are only repaired when some duplicate was merged
+        index, replaceRef, _ = self.rewriters(text)
+        return [ref.match.span() for ref in index
+                if replaceRef(ref) != ref.text]
+
 
 class EmptyTag(CheckWikiError):
 
+    required = ('</',)
     number = 85
     summary = 'odstranění prázdného tagu'
     tags = ('center', 'code', 'div', 'gallery', 'includeonly', 'noinclude',
@@ -1046,7 +1211,7 @@ class EmptyTag(CheckWikiError):
 
     def pattern(self):
         # todo: add attributes and whitelist some of them
-        return re.compile(r'<(%s)>(\s*)</\1>' % '|'.join(self.tags))
+        return compile_pattern(r'<(%s)>(\s*)</\1>' % '|'.join(self.tags))
 
     def replacement(self, match):
         return match[2]
@@ -1097,7 +1262,10 @@ class DoubleHttp(CheckWikiError):
     summary = 'oprava externího odkazu'
 
     def pattern(self):
-        return re.compile('(?i)(?:https?:*/*){2,}')
+        return compile_pattern('(?i)(?:https?:*/*){2,}')
+
+    def precheck(self, text):
+        return 'http' in text.lower()
 
     def replacement(self, match):
         return match.group()[match.group().rfind('http'):]
@@ -1110,7 +1278,10 @@ class Ordinals(CheckWikiError):
     summary = 'oprava řadových číslovek'
 
     def pattern(self):
-        return re.compile(r'(?i)([1-9]\d*)<sup>(st|nd|rd|th)</sup>')
+        return compile_pattern(r'(?i)([1-9]\d*)<sup>(st|nd|rd|th)</sup>')
+
+    def precheck(self, text):
+        return '<sup>' in text.lower()
 
     def replacement(self, match):
         return match.expand(r'\1\2')
@@ -1118,11 +1289,12 @@ class Ordinals(CheckWikiError):
 
 class SuperfluousPipe(CheckWikiError):
 
+    required = ('{{!}}',)
     number = 103
     summary = 'odstranění zb. kouzelných slov'
 
     def pattern(self):
-        return re.compile(r'\[\[([^]|[{}]+)\{\{!\}\}([^]|[{}]+)\]\]')
+        return compile_pattern(r'\[\[([^]|[{}]+)\{\{!\}\}([^]|[{}]+)\]\]')
 
     def replacement(self, match):
         return match.expand(r'[[\1|\2]]')
@@ -1130,11 +1302,12 @@ class SuperfluousPipe(CheckWikiError):
 
 class ReferenceQuotes(CheckWikiError):
 
+    required = ('<ref ',)
     number = 104
     summary = 'oprava uvozovek v referencích'
 
     def pattern(self):
-        return re.compile('<ref (?P<params>((?! */>)[^>])+?)(?P<slash> ?/)?>')
+        return compile_pattern('<ref (?P<params>((?! */>)[^>])+?)(?P<slash> ?/)?>')
 
     def replacement(self, match):
         def handleParam(p):
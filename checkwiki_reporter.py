@@ -0,0 +1,142 @@
+import atexit
+import json
+import queue
+import threading
+import time
+
+import pywikibot
+import requests
+
+
+class CheckWikiReporter:
+
+    '''
+    Class marking fixed CheckWiki errors in a background thread
+
+    Marks are queued and sent over a single HTTP session, so saving
+    pages does not wait for the service. Each mark is written to
+    a journal before it is queued and confirmed there once sent.
+    Marks not confirmed before a crash are sent on the next start.
+    '''
+
+    def __init__(self, url, journal=None, *, size=500, batch=50, retries=4,
+                 backoff=1.0, timeout=30, session=None):
+        self.url = url
+        self.journal = journal
+        self.batch = batch
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        self.queue = queue.Queue(size)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.sent = 0
+        self.failed = 0
+
+    @staticmethod
+    def key(data):
+        return f"{data['project']}|{data['id']}|{data['title']}"
+
+    def load_journal(self):
+        '''Return marks from the journal which were not sent'''
+        unsent = {}
+        try:
+            with open(self.journal, encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # cut off by a crash
+                    if 'sent' in record:
+                        unsent.pop(record['sent'], None)
+                    else:
+                        unsent[self.key(record)] = record
+        except FileNotFoundError:
+            pass
+        return list(unsent.values())
+
+    def write_journal(self, records, mode='a'):
+        if not self.journal:
+            return
+        with self.lock, open(self.journal, mode, encoding='utf-8') as file:
+            file.writelines(json.dumps(record, ensure_ascii=False) + '\n'
+                            for record in records)
+
+    def start(self):
+        '''Start the worker and replay marks left in the journal'''
+        if self.thread is not None:
+            return
+        unsent = self.load_journal() if self.journal else []
+        # keep only what is still to be sent
+        self.write_journal(unsent, mode='w')
+        self.thread = threading.Thread(
+            target=self.run, name='CheckWikiReporter', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+        if unsent:
+            pywikibot.info(
+                f'Replaying {len(unsent)} unsent CheckWiki marks')
+        for data in unsent:
+            self.queue.put(data)
+
+    def mark(self, data):
+        '''Queue the mark, blocks when the queue is full'''
+        if self.thread is None:
+            self.start()
+        self.write_journal([data])
+        self.queue.put(data)
+
+    def run(self):
+        closing = False
+        while not closing:
+            items = [self.queue.get()]
+            # drain what else is ready so that it is confirmed at once
+            while len(items) < self.batch:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in items:
+                closing = True
+                items = [data for data in items if data is not None]
+            done = [data for data in items if self.send(data)]
+            self.write_journal({'sent': self.key(data)} for data in done)
+            self.sent += len(done)
+            self.failed += len(items) - len(done)
+
+    def send(self, data):
+        '''Post the mark, return whether it does not need to be sent again'''
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = self.session.post(
+                    self.url, data, timeout=self.timeout)
+            except requests.RequestException as exc:
+                error = exc
+                continue
+            if response.status_code == 429 or response.status_code >= 500:
+                error = f'HTTP {response.status_code}'
+                continue
+            if response.status_code >= 400:
+                # the request itself is wrong, retrying would not help
+                pywikibot.warning(f'CheckWiki rejected {data}: '
+                                  f'HTTP {response.status_code}')
+            return True
+
+        pywikibot.warning(f'Could not mark {data} as fixed: {error}')
+        return False
+
+    def close(self, timeout=None):
+        '''Send the queued marks and stop the worker'''
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join(timeout)
+        self.thread = None
+        atexit.unregister(self.close)
+        self.session.close()
+        if self.sent or self.failed:
+            pywikibot.info(f'{self.sent} CheckWiki marks sent, '
+                           f'{self.failed} left for the next run')
@@ -6,6 +6,7 @@ For use in user_fixes.py, please add to the file:
 from scripts.myscripts.custome_fixes import lazy_fixes
 fixes.update((key, fix.dictForUserFixes()) for key, fix in lazy_fixes.items())
 """
+import json
 import re
 
 from collections import defaultdict
@@ -15,14 +16,19 @@ from operator import itemgetter
 import mwparserfromhell
 import pywikibot
 
-from pywikibot import pagegenerators, textlib
+from pywikibot import config, pagegenerators, textlib
 from pywikibot.exceptions import NoPageError
 from pywikibot.tools import first_lower, first_upper
 from pywikibot.tools.formatter import color_format
+from pywikibot.tools.itertools import itergroup
 
 from checkwiki_errors import CheckWikiError
+from protected_regions import replace_except
+from references import ReferenceIndex
 from tools import deduplicate, FULL_ARTICLE_REGEX
-from typoloader import TypoRule, TyposLoader
+from typoloader import TypoRule, TypoRuleSet, TyposLoader
+from typowatchdog import RegexWatchdog
+from wikitext_document import get_view
 
 
 class FixGenerator:
@@ -50,6 +56,10 @@ class BaseFix:
     key = None
     options = {}
     order = 0
+    document = None  # WikitextDocument of the page, set by the bot
+    # whether the fix can run in a worker process: it only needs
+    # the text and site data, no network, no operator, no callbacks
+    parallel = False
 
     def __init__(self, **kwargs):
         options = self.options.copy()
@@ -77,6 +87,14 @@ class BaseFix:
     def generator(self):
         return iter([])
 
+    def prepare_worker(self):
+        '''Prepare the fix for running in a forked worker process'''
+        pass
+
+    def get_view(self, view, text):
+        '''Return the view of the text, shared with other fixes if possible'''
+        return get_view(self.document, view, text, self.site)
+
 
 class Fix(BaseFix):
 
@@ -126,7 +144,7 @@ class LazyFix(BaseFix):
 
     def safeSub(self, text, find, replace):
         exceptions = self.exceptions
-        return textlib.replaceExcept(
+        return replace_except(
             text, find, replace,
             exceptions.get('inside', []) + exceptions.get('inside-tags', []),
             site=self.site)
@@ -183,7 +201,9 @@ class AdataFix(Fix):
     def apply(self, page, summaries=[], callbacks=[]):
         text = page.text
         adata = '{{Autoritní data}}'  # fixme: l10n
-        if adata.lower() in text.lower():  # fixme: with parameters
+        if adata.lower() in text.lower() or any(
+                first_upper(name.replace('_', ' ')) == adata[2:-2]
+                for name, _ in self.get_view('templates', text)):
             return
 
         try:
@@ -226,6 +246,7 @@ class CategoriesFix(LazyFix):
 
     key = 'categories'
     message = 'oprava řazení kategorií'
+    parallel = True
 
     def generator(self):
         pass  # incategory:"Muži|Ženy|Žijící lidé" insource:/\[\[Kategorie:[^]|[]+\|[^],]+,/
@@ -345,7 +366,7 @@ class CategoriesFix(LazyFix):
     def apply(self, page, summaries=[], *args):
         result = super().apply(page, summaries, *args)
         if result:
-            categories = textlib.getCategoryLinks(page.text, site=self.site)
+            categories = list(self.get_view('categories', page.text))
             categories.sort(key=self.sortCategories)
             page.text = textlib.replaceCategoryLinks(page.text, categories,
                                                      self.site)
@@ -362,6 +383,7 @@ class FilesFix(LazyFix):
              'img_super', 'img_text_bottom', 'img_text_top', 'img_thumbnail',
              'img_top', 'img_upright', 'img_width')
     message = 'úpravy obrázků'
+    parallel = True
     regex = r'\[\[\s*(?:%s)\s*:\s*[^]|[]+(?:\|(?:[^]|[]|\[\[[^]]+\]\])+)+\]\]'
 
     def load(self):
@@ -467,7 +489,11 @@ class CheckWikiFix(LazyFix):  # todo: make abstract and split
     def apply(self, page, summaries=[], callbacks=[]):
         replaced = []
         fixed = []
-        page.text = self.checkwiki.apply(page.text, page, replaced, fixed)
+        self.checkwiki.document = self.document
+        try:
+            page.text = self.checkwiki.apply(page.text, page, replaced, fixed)
+        finally:
+            self.checkwiki.document = None
         if replaced:  # todo: maxsummarycw
             summaries.append(f"[[WP:WCW|CheckWiki]]: {', '.join(replaced)}")
             callbacks.append(
@@ -528,9 +554,10 @@ class RedirectFix(LazyFix):
                 followRedirects=False, filterRedirects=False, namespaces=0)
 
     def get_redirects(self):
-        redirects = []  # todo: set?
+        redirects = []
         pywikibot.info('Loading redirects')
         page = pywikibot.Page(self.site, self.page_title)
+        self.list_page = page
         text = page.text.partition('{{SHORTTOC}}\n')[2]
         for line in text.splitlines():
             if line.strip() == '':
@@ -542,30 +569,90 @@ class RedirectFix(LazyFix):
         return redirects
 
     def load(self):
-        self.cache = {}
-        self.redirects = self.get_redirects()
+        self.list_page = None
+        self.redirects = set(self.get_redirects())
         pywikibot.info(f'{len(self.redirects)} redirects loaded')
+        self.cache = self.load_cache()
+        if self.cache is None:
+            self.cache = self.resolve_redirects(self.redirects)
+            self.save_cache()
+        self.redirects &= self.cache.keys()
+
+    def cache_key(self):
+        '''Return key of the list in the cache or None if not cacheable'''
+        if self.list_page is None:
+            return None
+        return f'{self.site}:{self.list_page.title()}'
+
+    def load_cache(self):
+        '''Return targets cached for the latest revision of the list'''
+        key = self.cache_key()
+        if key is None:
+            return None
+        try:
+            with open(config.datafilepath('redirects-cache.json'),
+                      encoding='utf-8') as file:
+                cache = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+        entry = cache.get(key)
+        if entry and entry['revision'] == self.list_page.latest_revision_id:
+            return entry['targets']
+        return None
+
+    def save_cache(self):
+        key = self.cache_key()
+        if key is None:
+            return
+        path = config.datafilepath('redirects-cache.json')
+        try:
+            with open(path, encoding='utf-8') as file:
+                cache = json.load(file)
+        except (FileNotFoundError, ValueError):
+            cache = {}
+        cache[key] = {
+            'revision': self.list_page.latest_revision_id,
+            'targets': self.cache,
+        }
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(cache, file, ensure_ascii=False)
+
+    def resolve_redirects(self, titles, batch=50):
+        '''Return targets of the redirects, queried in batches'''
+        pywikibot.info('Resolving redirects')
+        targets = {}
+        for group in itergroup(sorted(titles), batch):
+            data = self.site.simple_request(
+                action='query', titles=group, redirects=True).submit()
+            query = data.get('query', {})
+            normalized = {item['from']: item['to']
+                          for item in query.get('normalized', [])}
+            redirects = {}
+            for item in query.get('redirects', []):
+                target = item['to']
+                if item.get('tofragment'):
+                    target += f"#{item['tofragment']}"
+                redirects[item['from']] = target
+            pages = query.get('pages', {})
+            if isinstance(pages, dict):
+                pages = pages.values()
+            missing = {page['title'] for page in pages if 'missing' in page}
+
+            for link in group:
+                title = normalized.get(link, link)
+                if title in redirects:
+                    target = redirects[title]
+                    targets[link] = (first_lower(target)
+                                     if link == first_lower(link) else target)
+                elif title in missing:
+                    pywikibot.warning(f'{title} does not exist')
+                else:
+                    pywikibot.warning(f'{title} is not a redirect')
+        return targets
 
     def from_cache(self, link):
         link = link.replace('_', ' ').strip()  # todo: normalize completely
-        if link not in self.redirects:
-            return False
-
-        if link not in self.cache:
-            page = pywikibot.Page(self.site, link)
-            if not page.exists():
-                pywikibot.warning(f'{page.title()} does not exist')
-                self.redirects.remove(link)  # fixme: both cases
-                return False
-            if not page.isRedirectPage():
-                pywikibot.warning(f'{page.title()} is not a redirect')
-                self.redirects.remove(link)  # fixme: both cases
-                return False
-
-            target = page.getRedirectTarget()
-            title = target.title()
-            self.cache[link] = first_lower(title) if link == first_lower(link) else title
-        return self.cache[link]
+        return self.cache.get(link, False)
 
     def replacements(self):
         yield (r'\[\[([^]|[<>]+)\|', self.replace1)
@@ -630,6 +717,19 @@ class RedirectsFromFileFix(RedirectFix):
             site=self.site)]
         
 
+class SortableRefIndex(ReferenceIndex):
+
+    '''Index of references in the syntax RefSortFix can reorder'''
+
+    regex = re.compile(
+        '<ref(?:(?: name *=([^/=>]+))?>(?:(?!</ref>).)+</ref|'
+        ' name *=([^/=>]+)/)>', re.S)
+
+    def parse(self, match):
+        name = match.group(1) or match.group(2)
+        return (name.strip('" \'') if name else None), '', None
+
+
 class RefSortFix(LazyFix):
 
     '''
@@ -639,28 +739,27 @@ class RefSortFix(LazyFix):
     key = 'sortref'
     message = 'seřazení referencí'
     order = 2  # after checkwiki
+    parallel = True
 
     def load(self):
-        self.regex_single = re.compile(
-            '<ref(?:(?: name *=([^/=>]+))?>(?:(?!</ref>).)+</ref|'
-            ' name *=([^/=>]+)/)>', re.S)
+        self.regex_single = SortableRefIndex.regex
         self.regex_adjacent = re.compile(
             r'(?:\s*<ref(?:(?: name *=[^/=>]+)?>(?:(?!</ref>).)+</ref|'
             ' name *=[^/=>]+/)>){2,}', re.S)
 
-    def sortkey(self, ref, all_names, start):
+    def sortkey(self, ref, index, start):
         if name := ref.group(1) or ref.group(2):
             name = name.strip('" \'')
-            for i, (j, s) in enumerate(all_names):
-                if j == name and start + ref.start() > s:
-                    return i
+            first = index.first(name)
+            if first is not None and start + ref.start() > first.start:
+                return index.position(name)
 
-        return len(all_names)
+        return len(index.by_name)
 
-    def replace_refs(self, match, all_names):
+    def replace_refs(self, match, index):
         refs = list(self.regex_single.finditer(match.group()))
         assert len(refs) > 1
-        refs.sort(key=lambda ref: self.sortkey(ref, all_names, match.start()))
+        refs.sort(key=lambda ref: self.sortkey(ref, index, match.start()))
         space_before = match.group()[
             :len(match.group()) - len(match.group().lstrip())]
         return space_before + ''.join(ref.group() for ref in refs)
@@ -673,20 +772,9 @@ class RefSortFix(LazyFix):
         if 'group=' in text or '<references>' in text: # todo
             return text
 
-        all_names = []
-        for match in self.regex_single.finditer(text):
-            name = match.group(1) or match.group(2)
-            if not name:
-                continue
-            name = name.strip('" \'')
-            for i, _ in all_names:
-                if i == name:
-                    break
-            else:
-                all_names.append((name, match.start()))
-
-        if all_names:
-            callback = lambda match: self.replace_refs(match, all_names)
+        index = SortableRefIndex(text)
+        if index.by_name:
+            callback = lambda match: self.replace_refs(match, index)
             text = self.regex_adjacent.sub(callback, text)
 
         return text
@@ -720,6 +808,7 @@ class SectionsFix(LazyFix):
                         )
     message = 'standardizace závěrečných sekcí'
     order = 3
+    parallel = True
 
     def load(self):
         self.parser = mwparserfromhell
@@ -735,6 +824,14 @@ class SectionsFix(LazyFix):
     def iter_all_headers(self):
         return chain(self.headers_in_order, self.bad_headers, [self.root_header])
 
+    def apply(self, page, *args):
+        # the shared tree is only read, replace() parses a copy to change
+        for header in self.get_view('tree', page.text).ifilter_headings():
+            name = header.title.strip()
+            if self.replace_headers.get(name, name) in self.iter_all_headers():
+                return super().apply(page, *args)
+        return False
+
     def add_contents(self, sections, code):
         next_index = code.nodes.index(sections[0]['nodes'][-1])
         for i in range(1, len(sections)):
@@ -870,13 +967,14 @@ class StyleFix(Fix):  # todo: split and delete
 
     key = 'mos'
     order = 2  # after checkwiki
+    parallel = True
 
     def apply(self, page, *args):
         # remove empty list items
         page.text = re.sub(r'^\* *\n', '', page.text, flags=re.M)
 
         # sort categories
-        categories = textlib.getCategoryLinks(page.text, site=page.site)
+        categories = list(self.get_view('categories', page.text))
         category_living = pywikibot.Category(page.site, 'Žijící lidé')
         if category_living in categories:
             if any(cat.title(with_ns=False).startswith('Úmrtí ')
@@ -903,6 +1001,11 @@ class TemplateFix(LazyFix):
         self.cache = {}
         self.defaultsort = self.site.getmagicwords('defaultsort')
 
+    def apply(self, page, *args):
+        if self.get_view('templates', page.text):
+            return super().apply(page, *args)
+        return False
+
     def replacements(self):
         yield (
             r'(?P<before>\{\{\s*)(?P<template>[^<>#{|}]+?)(?P<after>\s*[|}])',
@@ -949,6 +1052,7 @@ class TypoFix(LazyFix):
     Additional arguments:
     * -maxsummarytypos - how many typo replacements to show in edit
       summary at most?
+    * -typosbudget - how many seconds can a rule take on a page
     * -typospage
     * -whitelistpage
     '''
@@ -956,6 +1060,7 @@ class TypoFix(LazyFix):
     key = 'typos'
     options = {
         'maxsummarytypos': 5,
+        'typosbudget': 5,
         'typospage': None,
         'whitelistpage': None,
     }
@@ -964,10 +1069,14 @@ class TypoFix(LazyFix):
     }
     message = 'oprava překlepů'
     order = 1  # after redirects
+    parallel = True
 
     def load(self):
         loader = TyposLoader(self.site)
         self.typoRules = loader.loadTypos()
+        self.ruleset = TypoRuleSet(
+            self.typoRules, loader.prefilter,
+            RegexWatchdog(self.typosbudget, loader.quarantine))
         self.whitelist = loader.loadWhitelist()
 
     def generator(self):
@@ -975,21 +1084,29 @@ class TypoFix(LazyFix):
             self.site.search(rule.query, namespaces=[0])
             for rule in self.typoRules if rule.query is not None)
 
+    def prepare_worker(self):
+        # the watchdog process belongs to the parent
+        watchdog = self.ruleset.watchdog
+        if watchdog is not None:
+            watchdog.process = None
+        # nobody can answer questions in a worker
+        rules = [rule for rule in self.typoRules
+                 if not rule.needs_decision()]
+        if len(rules) < len(self.typoRules):
+            self.typoRules = rules
+            self.ruleset = TypoRuleSet(
+                rules, self.ruleset.prefilter, watchdog)
+
     def replacements(self):
-        return ((rule.find.pattern, rule.replacements[0])
+        return ((rule.pattern, rule.replacements[0])
                 for rule in self.typoRules)
 
     def apply(self, page, summaries=[], callbacks=[]):
         title = page.title()
         if title in self.whitelist:
             return
-        text = page.text
         replaced = []
-        for rule in self.typoRules:
-            if rule.matches(title):
-                continue
-            text = rule.apply(text, replaced)
-        page.text = text
+        page.text = self.ruleset.apply(page.text, replaced, title=title)
         count = len(replaced)
         if count > 0:  # todo: separate function
             if count > 1:
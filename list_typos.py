@@ -1,16 +1,21 @@
 #!/usr/bin/python
+import json
+import multiprocessing
 import re
 
 from collections import defaultdict
 
 import pywikibot
 
-from pywikibot import textlib
+from pywikibot import config, textlib
 from pywikibot.bot import SingleSiteBot, ExistingPageBot
 from pywikibot.pagegenerators import PreloadingGenerator
 from pywikibot.tools.itertools import itergroup
+from pywikibot.xmlreader import XmlDump
 
+from tools import fork_context
 from typoloader import TypoRule, TyposLoader
+from typostats import aggregate_history, load_history
 
 
 class TypoReportBot(SingleSiteBot):
@@ -21,6 +26,7 @@ class TypoReportBot(SingleSiteBot):
         self.available_options.update({
             'always': True,
             'anything': False,
+            'outputfile': None,
             'outputpage': None,
             'typospage': None,
             'whitelistpage': None,
@@ -78,43 +84,179 @@ class TypoReportBot(SingleSiteBot):
         return textlib.removeDisabledParts(
             text, TypoRule.exceptions, site=self.site)
 
-    def treat(self, page):
-        match = self.current_rule.find.search(page.text)
-        if not match:
-            return
-        text = self.remove_disabled_parts(page.text)
+    @classmethod
+    def iter_matches(cls, rule, text, link, false_positives):
+        '''Yield distinct texts matched by the rule worth reporting'''
         found = set()
-        for match in self.current_rule.find.finditer(text):
+        for match in rule.find.finditer(text):
             match_text = match[0]
             if match_text in found:
                 continue
             found.add(match_text)
-            link = page.title(as_link=True)
-            put_text = self.pattern.format(link, match_text)
-            if put_text[2:] not in self.false_positives:
-                pywikibot.stdout(put_text)
-                if not self.data.get(link):
-                    self.order.append(link)
-                self.data[link].append(match_text)
+            put_text = cls.pattern.format(link, match_text)
+            if put_text[2:] not in false_positives:
+                yield match_text
+
+    def treat(self, page):
+        match = self.current_rule.find.search(page.text)
+        if not match:
+            return
+        text = self.remove_disabled_parts(page.text)
+        link = page.title(as_link=True)
+        for match_text in self.iter_matches(
+                self.current_rule, text, link, self.false_positives):
+            pywikibot.stdout(self.pattern.format(link, match_text))
+            if not self.data.get(link):
+                self.order.append(link)
+            self.data[link].append(match_text)
+
+    def iter_report(self):
+        for link in self.order:
+            for match in self.data[link]:
+                yield self.pattern.format(link, match)
+
+    def save_report_file(self):
+        with open(self.opt.outputfile, 'w', encoding='utf-8') as file:
+            file.writelines(f'{line}\n' for line in self.iter_report())
 
     def teardown(self):
         outputpage = self.opt.outputpage
+        if self.opt.outputfile:
+            self.save_report_file()
         if (self.generator_completed or self.opt.anything) and outputpage:
-            put = []
-            for link in self.order:
-                put.extend(self.pattern.format(link, match) for match in self.data[link])
             page = pywikibot.Page(self.site, outputpage)
-            page.text = '\n'.join(put)
+            page.text = '\n'.join(self.iter_report())
             page.save(summary='aktualizace seznamu překlepů', minor=False,
                       botflag=False, apply_cosmetic_changes=False)
         super().teardown()
 
 
-class PurgeTypoReportBot(SingleSiteBot, ExistingPageBot):
+_dump_bot = None  # set in each worker process
+
+
+def _init_dump_worker(bot):
+    global _dump_bot
+    _dump_bot = bot
+
+
+def _scan_dump_entry(entry):
+    title, text = entry
+    bot = _dump_bot
+    prefilter = bot.loader.prefilter
+    candidates = prefilter.candidates(text)
+    link = f'[[{title}]]'
+    cleaned = None
+    matches = []
+    for rule in bot.typoRules:
+        if prefilter.covers(rule) and rule.id not in candidates:
+            continue
+        if rule.find.search(title) or not rule.find.search(text):
+            continue
+        if cleaned is None:
+            cleaned = bot.remove_disabled_parts(text)
+        matches.extend(bot.iter_matches(
+            rule, cleaned, link, bot.false_positives))
+    return link, matches
+
+
+class XmlTypoReportBot(TypoReportBot):
+
+    '''
+    Bot listing typos found in a local XML dump
+
+    Supported parameters:
+    * -xml: - path to the (compressed) dump with page texts
+    * -outputfile: - where to write the report
+    * -processes:# - how many worker processes to use
+
+    Worker processes are forked, so this does not run where fork is not
+    available (Windows).
+    '''
+
+    batch = 200
+    pool = None
 
     def __init__(self, **kwargs):
+        self.available_options.update({
+            'processes': None,
+            'xml': None,
+        })
+        super().__init__(**kwargs)
+
+    def setup(self):
+        super().setup()
+        if not self.opt.outputfile:
+            self.opt.outputfile = config.datafilepath('typos-report.txt')
+        self.output = open(self.opt.outputfile, 'w', encoding='utf-8')
+        # load site data needed by the workers before forking them
+        self.remove_disabled_parts('')
+        # fork before the generator or anything else starts threads
+        self.processes = self.opt.processes or multiprocessing.cpu_count()
+        self.pool = fork_context().Pool(
+            self.processes, initializer=_init_dump_worker, initargs=(self,))
+
+    def iter_entries(self):
+        for entry in XmlDump(self.opt.xml).parse():
+            if entry.ns != '0' or entry.isredirect:
+                continue
+            if entry.title in self.whitelist:
+                continue
+            yield entry.title, entry.text
+
+    @property
+    def generator(self):
+        # bounded batches keep the memory flat, Pool.imap would read
+        # the whole dump ahead
+        for entries in itergroup(self.iter_entries(),
+                                 self.batch * self.processes):
+            for link, matches in self.pool.imap(_scan_dump_entry, entries, 8):
+                if matches:
+                    self.matches = matches
+                    yield pywikibot.Page(self.site, link[2:-2])
+
+    def skip_page(self, page):
+        return False
+
+    def treat(self, page):
+        link = page.title(as_link=True)
+        for match_text in self.matches:
+            line = self.pattern.format(link, match_text)
+            pywikibot.stdout(line)
+            self.output.write(f'{line}\n')
+
+    def iter_report(self):
+        with open(self.opt.outputfile, encoding='utf-8') as file:
+            for line in file:
+                yield line.rstrip('\n')
+
+    def save_report_file(self):
+        pass  # written while scanning
+
+    def teardown(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        self.output.close()
+        super().teardown()
+
+
+class PurgeTypoReportBot(SingleSiteBot, ExistingPageBot):
+
+    '''
+    Bot removing fixed typos from the report
+
+    Revision of each listed page is remembered when its lines are
+    verified. Next time, only revision metadata is loaded and pages
+    which have not been edited since are not checked again.
+
+    Supported parameters:
+    * -full - check all pages regardless of the remembered revisions
+    '''
+
+    def __init__(self, full=False, **kwargs):
         self.helper = TypoReportBot(**kwargs)
         super().__init__(site=self.helper.site)
+        self.full = full
         self.put = []
         self.cache = defaultdict(list)
 
@@ -123,6 +265,21 @@ class PurgeTypoReportBot(SingleSiteBot, ExistingPageBot):
         self.whitelist = self.helper.loader.loadWhitelist()
         self.generator = [pywikibot.Page(self.site, self.helper.opt.outputpage)]
         self.helper.load_false_positives()
+        self.state_path = config.datafilepath('typos-purge.json')
+        self.state_key = f'{self.site}:{self.helper.opt.outputpage}'
+        try:
+            with open(self.state_path, encoding='utf-8') as file:
+                self.state = json.load(file)
+        except FileNotFoundError:
+            self.state = {}
+        self.revisions = {} if self.full else self.state.get(
+            self.state_key, {})
+        self.verified = {}
+
+    def save_state(self):
+        self.state[self.state_key] = self.verified
+        with open(self.state_path, 'w', encoding='utf-8') as file:
+            json.dump(self.state, file, ensure_ascii=False)
 
     def line_iterator(self, text):
         regex = re.compile(self.helper.pattern.format(
@@ -131,33 +288,96 @@ class PurgeTypoReportBot(SingleSiteBot, ExistingPageBot):
             if match := regex.fullmatch(line):
                 title, text = match.groups()
                 entry = pywikibot.Page(self.site, title)
-                self.cache[entry.title()].append(text)
-                yield entry
+                key = entry.title()
+                if key not in self.cache:
+                    self.put.append((key,))
+                    yield entry
+                self.cache[key].append(text)
             else:
                 self.put.append(line)
 
-    def treat(self, page):
+    def filter_lines(self, title, strings, text=None):
         pattern = self.helper.pattern
-        for entry in PreloadingGenerator(self.line_iterator(page.text)):
-            key = title = entry.title()
-            if not entry.exists():
-                self.cache.pop(key)
+        lines = []
+        for string in strings:
+            if text is not None and string not in text:
+                continue
+            put_text = pattern.format(f'[[{title}]]', string)
+            if put_text[2:] in self.helper.false_positives:
                 continue
+            lines.append(put_text)
+        return lines
+
+    def treat(self, page):
+        entries = list(self.line_iterator(page.text))
+        checked = {}
+        outdated = []
+        # only revision metadata, texts are loaded for changed pages
+        for entry in self.site.preloadpages(entries, content=False):
+            key = entry.title()
+            if not entry.exists():
+                checked[key] = []
+            elif (not entry.isRedirectPage()
+                  and self.revisions.get(key) == entry.latest_revision_id):
+                checked[key] = self.filter_lines(key, self.cache[key])
+                self.verified[key] = entry.latest_revision_id
+            else:
+                outdated.append(entry)
+
+        pywikibot.info(f'{len(outdated)} of {len(entries)} pages changed '
+                       'since the last purge')
+        for entry in PreloadingGenerator(outdated):
+            key = title = entry.title()
             while entry.isRedirectPage():
                 entry = entry.getRedirectTarget()
                 title = entry.title()
+            if not entry.exists():
+                checked[key] = []
+                continue
             text = self.helper.remove_disabled_parts(entry.text)
-            for string in self.cache.pop(key):
-                if string not in text:
-                    continue
-                put_text = pattern.format(f'[[{title}]]', string)
-                if put_text[2:] in self.helper.false_positives:
-                    continue
-                self.put.append(put_text)
-
-        page.text = '\n'.join(self.put)
+            checked[key] = lines = self.filter_lines(
+                title, self.cache[key], text)
+            if lines:
+                self.verified[title] = entry.latest_revision_id
+
+        output = []
+        for line in self.put:
+            if isinstance(line, tuple):
+                output.extend(checked.get(line[0], []))
+            else:
+                output.append(line)
+        page.text = '\n'.join(output)
         page.save(summary='odstranění vyřešených překlepů', minor=True,
                   botflag=True, apply_cosmetic_changes=False)
+        self.save_state()
+
+
+def show_history(limit=10, allsites=False, **kwargs):
+    site = None if allsites else pywikibot.Site()
+    totals = aggregate_history(load_history(site=site))
+    if not totals:
+        pywikibot.info('No rule statistics recorded yet')
+        return
+
+    pywikibot.info('Most expensive rules:')
+    ranking = sorted(totals.items(), key=lambda pair: pair[1]['total'],
+                     reverse=True)[:limit]
+    for i, (pattern, data) in enumerate(ranking, start=1):
+        pywikibot.info(
+            f'{i}. "{pattern}" - {data["total"]:.3f}s in {data["calls"]} '
+            f'calls (p95 {data["p95"]:.4f}s, max {data["max"]:.4f}s)')
+
+    pywikibot.info('\nLeast productive rules:')
+    ranking = sorted(
+        (pair for pair in totals.items() if pair[1]['calls']),
+        key=lambda pair: (pair[1]['accepted'] / pair[1]['calls'],
+                          -pair[1]['total']))[:limit]
+    for i, (pattern, data) in enumerate(ranking, start=1):
+        pywikibot.info(
+            f'{i}. "{pattern}" - {data["accepted"]} of {data["matches"]} '
+            f'matches accepted in {data["calls"]} calls, '
+            f'{data["title_skips"]} pages skipped by title '
+            f'({data["runs"]} runs)')
 
 
 def main(*args):
@@ -166,6 +386,15 @@ def main(*args):
     for arg in pywikibot.handle_args(args):
         if arg == 'purge':
             cls = PurgeTypoReportBot
+        elif arg.startswith('-xml:'):
+            if fork_context() is None:
+                pywikibot.error('Scanning a dump needs to fork worker '
+                                'processes, which this platform cannot do')
+                return
+            cls = XmlTypoReportBot
+            options['xml'] = arg[len('-xml:'):]
+        elif arg == 'stats':
+            cls = None
         elif arg.startswith('-'):
             arg, sep, value = arg.partition(':')
             if value != '':
@@ -173,6 +402,10 @@ def main(*args):
             else:
                 options[arg[1:]] = True
 
+    if cls is None:
+        show_history(**options)
+        return
+
     bot = cls(**options)
     bot.run()
 
@@ -0,0 +1,234 @@
+import re
+
+from bisect import bisect_right
+from contextlib import suppress
+
+from pywikibot import textlib
+
+# the helper of textlib.replaceExcept, private in older pywikibot
+get_regexes = getattr(textlib, 'get_regexes', None) or textlib._get_regexes
+
+
+class ExceptionMatches:
+
+    '''
+    Memo of searches for exceptions in one text
+
+    textlib.replaceExcept searches every exception again from the
+    current index. A search from any index up to the start of the match
+    it found finds the same match, so the results are remembered as
+    intervals of such indices and reused for later searches.
+    '''
+
+    def __init__(self, text, regexes, prefill=False):
+        self.text = text
+        self.regexes = regexes
+        # for each regex: indices searched from and the matches found
+        self.known = [([], []) for _ in regexes]
+        if prefill:
+            for regex, (starts, matches) in zip(regexes, self.known):
+                index = 0
+                for match in regex.finditer(text):
+                    if index is not None:
+                        starts.append(index)
+                        matches.append(match)
+                    # after an empty match, finditer does not search
+                    # from its end the same way as search does
+                    index = match.end() if match.group() else None
+                if index is not None:
+                    starts.append(index)
+                    matches.append(None)
+
+    def search(self, i, index):
+        regex = self.regexes[i]
+        starts, matches = self.known[i]
+        j = bisect_right(starts, index) - 1
+        if j >= 0 and (matches[j] is None or index <= matches[j].start()):
+            return matches[j]
+        match = regex.search(self.text, index)
+        starts.insert(j + 1, index)
+        matches.insert(j + 1, match)
+        return match
+
+    def first(self, index):
+        '''Return the earliest match of any exception from the index'''
+        first = None
+        for i in range(len(self.regexes)):
+            match = self.search(i, index)
+            if match and (first is None or match.start() < first.start()):
+                first = match
+        return first
+
+
+class KnownMatches:
+
+    '''
+    Regex answering searches in one text by matches found before
+
+    The spans are those of finditer() on the text, e.g. in a worker
+    process. A search from an index up to the start of the next known
+    match only matches the regex there. Other searches, and those in
+    another text, are done by the regex.
+    '''
+
+    def __init__(self, regex, text, spans):
+        self.regex = regex
+        self.text = text
+        # indices searched from and the spans found
+        self.starts = []
+        self.spans = []
+        index = 0
+        for start, end in spans:
+            if index is not None:
+                self.starts.append(index)
+                self.spans.append((start, end))
+            # after an empty match, finditer does not search from its
+            # end the same way as search does
+            index = end if end > start else None
+        if index is not None:
+            self.starts.append(index)
+            self.spans.append(None)
+
+    def __getattr__(self, name):
+        return getattr(self.regex, name)
+
+    def search(self, text, pos=0):
+        if text is self.text:
+            j = bisect_right(self.starts, pos) - 1
+            if j >= 0 and (self.spans[j] is None
+                           or pos <= self.spans[j][0]):
+                return self.spans[j] and self.regex.match(
+                    text, self.spans[j][0])
+        return self.regex.search(text, pos)
+
+
+class ProtectedRegionsCache:
+
+    '''
+    Cache of exception matches for the last seen text
+
+    Matches are kept for each set of exceptions until a different text
+    is requested, so fixes which do not change the text share them.
+    '''
+
+    def __init__(self):
+        self.text = None
+        self.site = None
+        self.regions = {}
+
+    def get(self, text, exceptions, site=None):
+        if text is not self.text and text != self.text or site != self.site:
+            self.text = text
+            self.site = site
+            self.regions = {}
+        key = tuple(exceptions)
+        if key not in self.regions:
+            regexes = get_regexes(list(exceptions), site)
+            self.regions[key] = ExceptionMatches(text, regexes, prefill=True)
+        return self.regions[key]
+
+    def adopt(self, other):
+        '''Take over the matches found by another cache'''
+        self.text = other.text
+        self.site = other.site
+        self.regions = other.regions
+
+
+default_cache = ProtectedRegionsCache()
+
+group_regex = re.compile(r'\\(\d+)|\\g<(.+?)>')
+
+
+def expand(match, new):
+    '''Expand group references the same way as textlib.replaceExcept'''
+    replacement = ''
+    last = 0
+    for group_match in group_regex.finditer(new):
+        group_id = group_match[1] or group_match[2]
+        with suppress(ValueError):
+            group_id = int(group_id)
+        replacement += new[last:group_match.start()]
+        replacement += match[group_id] or ''
+        last = group_match.end()
+    return replacement + new[last:]
+
+
+def replace_except(text, old, new, exceptions, site=None,
+                   cache=default_cache):
+    '''
+    Replace like textlib.replaceExcept but reuse the exception matches
+
+    Like there, the earliest exception from the current index is looked
+    up before each match and skipped if it does not start after it.
+    The searches are answered from the cache until the text is changed
+    by the first replacement, after that they are done on the new text.
+    '''
+    if isinstance(old, str):
+        old = re.compile(old)
+
+    if not old.search(text):
+        return text
+
+    exception_matches = cache.get(text, exceptions, site)
+    if not callable(new):
+        template = new.replace('\\n', '\n')
+        new = lambda match: expand(match, template)
+
+    index = 0
+    while index <= len(text):
+        match = old.search(text, index)
+        if not match:
+            break
+
+        exception = exception_matches.first(index)
+        if exception is not None and exception.start() <= match.start():
+            index = exception.end()
+            continue
+
+        replacement = new(match)
+        if replacement != match.group():
+            text = text[:match.start()] + replacement + text[match.end():]
+            exception_matches = ExceptionMatches(
+                text, exception_matches.regexes)
+        index = match.start() + len(replacement)
+        if not match.group():
+            index += 1
+
+    return text
+
+
+def find_except(text, old, new, exceptions, site=None, cache=default_cache):
+    '''
+    Yield matches which replace_except would change, without changing them
+
+    Exceptions are skipped the same way as by replace_except, but all
+    matches are searched for in the original text. Matches which would
+    be replaced with the same text are skipped.
+    '''
+    if isinstance(old, str):
+        old = re.compile(old)
+
+    if not old.search(text):
+        return
+
+    exception_matches = cache.get(text, exceptions, site)
+    if not callable(new):
+        template = new.replace('\\n', '\n')
+        new = lambda match: expand(match, template)
+
+    index = 0
+    while index <= len(text):
+        match = old.search(text, index)
+        if not match:
+            break
+
+        exception = exception_matches.first(index)
+        if exception is not None and exception.start() <= match.start():
+            index = exception.end()
+            continue
+
+        if new(match) != match.group():
+            yield match
+        index = match.end()
+        if not match.group():
+            index += 1
@@ -0,0 +1,101 @@
+import re
+
+
+class Reference:
+
+    '''One <ref> tag found by ReferenceIndex'''
+
+    __slots__ = ('match', 'name', 'group', 'content')
+
+    def __init__(self, match, name, group, content):
+        self.match = match
+        self.name = name
+        self.group = group
+        self.content = content
+
+    @property
+    def start(self):
+        return self.match.start()
+
+    @property
+    def end(self):
+        return self.match.end()
+
+    @property
+    def text(self):
+        return self.match.group()
+
+
+class ReferenceIndex:
+
+    '''
+    Index of <ref> tags in text built in a single pass
+
+    References are kept in the order of the text. Named ones can be
+    looked up by their group and name, and their names are numbered
+    in the order of their first occurrence.
+    '''
+
+    regex = re.compile(
+        '<ref(?= |>)(?P<params>[^>]*)'
+        '(?: ?/|>(?P<content>(?:(?!</?ref).)+)</ref)>',
+        re.S)
+
+    param_regex = re.compile(
+        '(?P<param>[a-z]+) *= *'
+        '(?P<quote>[\'"])?'
+        r'(?P<content>(?(quote)(?!(?P=quote)|>).|[\w-])+)'
+        '(?(quote)(?P=quote)|)')
+
+    def __init__(self, text):
+        self.text = text
+        self.refs = []
+        self.by_name = {}  # (group, name) -> references in order
+        for match in self.regex.finditer(text):
+            ref = Reference(match, *self.parse(match))
+            self.refs.append(ref)
+            if ref.name is not None:
+                self.by_name.setdefault((ref.group, ref.name), []).append(ref)
+        self._positions = None
+
+    def parse(self, match):
+        '''Return name (or None), group and stripped content (or None)'''
+        name = None
+        group = ''
+        for param in self.param_regex.finditer(match['params']):
+            if param['param'] == 'group':
+                group = param['content'].strip()
+            elif param['param'] == 'name':
+                name = param['content'].strip()
+        content = match['content']
+        if content is not None:
+            content = content.strip()
+        return name, group, content
+
+    def __iter__(self):
+        return iter(self.refs)
+
+    def __len__(self):
+        return len(self.refs)
+
+    def first(self, name, group=''):
+        '''Return the first reference with the name or None'''
+        refs = self.by_name.get((group, name))
+        return refs[0] if refs else None
+
+    def position(self, name, group=''):
+        '''Return the order of the first occurrence of the name'''
+        if self._positions is None:
+            self._positions = {key: i for i, key in enumerate(self.by_name)}
+        return self._positions[(group, name)]
+
+    def sub(self, function):
+        '''Return the text with each reference replaced by the function'''
+        parts = []
+        last = 0
+        for ref in self.refs:
+            parts.append(self.text[last:ref.start])
+            parts.append(function(ref))
+            last = ref.end
+        parts.append(self.text[last:])
+        return ''.join(parts)
@@ -0,0 +1,170 @@
+import re
+
+from collections import Counter
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:
+    import sre_constants
+    import sre_parse
+
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+
+class Re2Pattern:
+
+    '''
+    Pattern compiled by RE2 which can be used like one compiled by re
+
+    RE2 runs in linear time, so it cannot blow up on any text.
+    '''
+
+    backend = 're2'
+
+    inline_flags = ((re.IGNORECASE, 'i'), (re.MULTILINE, 'm'),
+                    (re.DOTALL, 's'))
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+        inline = ''.join(char for flag, char in self.inline_flags
+                         if flags & flag)
+        if inline:
+            pattern = f'(?{inline}){pattern}'
+        options = re2.Options()
+        options.log_errors = False  # re2.error is raised anyway
+        self.regex = re2.compile(pattern, options)
+
+    def __getattr__(self, name):
+        return getattr(self.regex, name)
+
+    def __repr__(self):
+        return f're2.compile({self.pattern!r}, {self.flags!r})'
+
+
+# operators RE2 does not support or which behave differently there
+_unsupported = {
+    sre_constants.ASSERT, sre_constants.ASSERT_NOT, sre_constants.GROUPREF,
+    sre_constants.GROUPREF_EXISTS,
+    # \d, \s, \w are ASCII only in RE2
+    sre_constants.CATEGORY,
+}
+for name in ('ATOMIC_GROUP', 'GROUPREF_IGNORE', 'POSSESSIVE_REPEAT'):
+    if hasattr(sre_constants, name):
+        _unsupported.add(getattr(sre_constants, name))
+
+# anchors which match the same way in RE2 (\b is ASCII only there)
+_supported_at = {sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_STRING}
+
+
+def _re2_reads_alike(pattern):
+    '''Return whether the source has no syntax RE2 reads differently'''
+    in_class = False
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == '\\':
+            index += 1
+        elif in_class:
+            if pattern.startswith('[:', index):
+                return False  # a POSIX class in RE2
+            if char == ']' and index > start:
+                in_class = False
+        elif char == '[':
+            in_class = True
+            start = index + 1  # a bracket right after is a member
+            if pattern.startswith('^', start):
+                start += 1
+        elif pattern.startswith('{,', index):
+            return False  # {,n} is a repeat in re, literal in RE2
+        index += 1
+    return True
+
+
+def _re2_compatible(items, flags):
+    for op, av in items:
+        if op in _unsupported:
+            return False
+        if op == sre_constants.AT:
+            # $ without re.M also matches before the final newline in re
+            if av not in _supported_at and not (
+                    av == sre_constants.AT_END and flags & re.MULTILINE):
+                return False
+        elif op == sre_constants.IN:
+            if any(sub_op == sre_constants.CATEGORY for sub_op, _ in av):
+                return False
+        elif op == sre_constants.SUBPATTERN:
+            if not _re2_compatible(av[-1], flags):
+                return False
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            low, high, sub = av
+            if high != sre_constants.MAXREPEAT and high > 1000:
+                return False
+            if not _re2_compatible(sub, flags):
+                return False
+        elif op == sre_constants.BRANCH:
+            if not all(_re2_compatible(sub, flags) for sub in av[1]):
+                return False
+    return True
+
+
+def classify(pattern, flags=0):
+    '''Return name of the fastest backend which supports the pattern'''
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except re.error:
+        return 're'
+    state = getattr(parsed, 'state', None) or parsed.pattern  # Python < 3.8
+    flags = state.flags
+    if flags & (re.VERBOSE | re.ASCII | re.LOCALE):
+        return 're'
+    if not _re2_reads_alike(pattern) or not _re2_compatible(parsed, flags):
+        return 're'
+    if re2 is not None:
+        try:
+            Re2Pattern(pattern, flags)
+        except re2.error:
+            return 're'
+    return 're2'
+
+
+def available(backend):
+    '''Return whether the backend is installed'''
+    return backend == 're' or backend == 're2' and re2 is not None
+
+
+def is_linear(backend):
+    '''Return whether patterns of the backend cannot blow up'''
+    return backend == 're2' and available(backend)
+
+
+def compile_pattern(pattern, flags=0, backend=None):
+    '''
+    Compile the pattern with the best available backend
+
+    Patterns which no other backend supports, or when it is not
+    installed, are compiled by re. Invalid patterns raise re.error.
+
+    :param backend: result of classify() if already known
+    '''
+    if backend is None:
+        backend = classify(pattern, flags)
+    if backend == 're2' and available(backend):
+        try:
+            return Re2Pattern(pattern, flags)
+        except re2.error:
+            pass
+    return re.compile(pattern, flags)
+
+
+def backend_of(regex):
+    '''Return name of the backend which compiled the regex'''
+    return getattr(regex, 'backend', 're')
+
+
+def count_backends(backends):
+    '''Return how many of the given backends will be actually used'''
+    return Counter(name if available(name) else 're' for name in backends)
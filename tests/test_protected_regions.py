@@ -0,0 +1,49 @@
+import random
+import re
+import unittest
+
+from pywikibot import textlib
+
+from protected_regions import ProtectedRegionsCache, replace_except
+
+
+class TestReplaceExcept(unittest.TestCase):
+
+    '''Compare replace_except with textlib.replaceExcept'''
+
+    alphabet = 'ab<>/ x'
+    patterns = ['a', 'ab', 'b+', 'a|b', 'x?', r'\bab', '(a)(b)?', ' ']
+    exception_patterns = [
+        '<x>.*?</x>', '<[^>]*>', 'aa', 'b a', r'<x>(?:(?!<x>).)*', 'ab?b',
+    ]
+    replacements = ['', 'b', r'\1', r'<\g<0>>', 'aa\\n']
+
+    def random_text(self, rng):
+        return ''.join(rng.choice(self.alphabet)
+                       for _ in range(rng.randint(0, 30)))
+
+    def test_random(self):
+        rng = random.Random(0)
+        for _ in range(5000):
+            text = self.random_text(rng)
+            old = re.compile(rng.choice(self.patterns))
+            new = rng.choice(self.replacements)
+            if old.groups < 1 and '\\1' in new:
+                continue
+            exceptions = [re.compile(pattern, re.S) for pattern in
+                          rng.sample(self.exception_patterns,
+                                     rng.randint(1, 3))]
+            cache = ProtectedRegionsCache()
+            with self.subTest(text=text, old=old.pattern, new=new,
+                              exceptions=[exc.pattern for exc in exceptions]):
+                self.assertEqual(
+                    replace_except(text, old, new, exceptions, cache=cache),
+                    textlib.replaceExcept(text, old, new, exceptions))
+                # once more with the matches taken from the cache
+                self.assertEqual(
+                    replace_except(text, old, new, exceptions, cache=cache),
+                    textlib.replaceExcept(text, old, new, exceptions))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,3 +1,4 @@
+import multiprocessing
 import re
 
 import pywikibot
@@ -32,6 +33,21 @@ class FileRegexHolder:
         return cls.replaceR
 
 
+def fork_context():
+    '''
+    Return the multiprocessing context forking worker processes
+
+    Workers get the loaded rules and site data of the parent process
+    through the initializer of their pool, without pickling them, which
+    only works when they are forked. This is not the default on macOS
+    and Windows, the latter cannot fork at all and None is returned
+    there. Pools should be created before the parent starts threads.
+    '''
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    return multiprocessing.get_context('fork')
+
+
 def deduplicate(arg):
     # todo: merge with filter_unique?
     for index, member in enumerate(arg, start=1):
@@ -1,11 +1,26 @@
+import json
 import re
 import time
 
+from collections import deque
+
 import pywikibot
 
-from pywikibot import textlib
+from pywikibot import config, textlib
 from pywikibot.tools.formatter import color_format
 
+from protected_regions import KnownMatches, replace_except
+from regex_backends import (
+    backend_of, classify, compile_pattern, count_backends, is_linear
+)
+from typostats import TypoRuleStats
+from typowatchdog import TypoQuarantine
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
 
 class IncompleteTypoRuleException(Exception):
 
@@ -48,12 +63,28 @@ class TypoRule:
 
     nowikiR = re.compile('</?nowiki>')
 
-    def __init__(self, find, replacements, auto=False, query=None):
-        self.find = find
+    def __init__(self, find, replacements, auto=False, query=None,
+                 backend=None):
+        if isinstance(find, str):
+            self.pattern = find
+            self._find = None  # compiled when first used
+            self.backend = backend or classify(find, re.M)
+        else:
+            self.pattern = find.pattern
+            self._find = find
+            self.backend = backend or backend_of(find)
         self.replacements = replacements
         self.auto = auto
         self.query = query
         self.longest = 0
+        self.stats = TypoRuleStats()
+
+    @property
+    def find(self):
+        if self._find is None:
+            self._find = compile_pattern(self.pattern, re.M, self.backend)
+            self.backend = backend_of(self._find)
+        return self._find
 
     def __eq__(self, other):
         return self.id == other.id if isinstance(other, self.__class__) else False
@@ -66,6 +97,23 @@ class TypoRule:
             self.__class__.name, self.find, self.replacements,
             self.auto, self.query)
 
+    def to_dict(self):
+        return {
+            'find': self.pattern,
+            'replacements': self.replacements,
+            'auto': self.auto,
+            'query': self.query,
+            'literals': self.literals,
+            'backend': self.backend,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        rule = cls(data['find'], data['replacements'], data['auto'],
+                   data['query'], data.get('backend'))
+        rule.literals = data['literals']
+        return rule
+
     def needs_decision(self):
         return not self.auto or len(self.replacements) > 1
 
@@ -76,9 +124,10 @@ class TypoRule:
 
         find = cls.nowikiR.sub('', parameters['1'])
         try:
-            find = re.compile(find, re.M)
+            re.compile(find, re.M)
         except re.error as exc:
             raise InvalidExpressionException(exc)
+        find = compile_pattern(find, re.M)
 
         replacements = []
         for key in '23456':
@@ -115,6 +164,7 @@ class TypoRule:
                 string = f'{string[:-1]}_'
             return string
 
+        self.stats.matches += 1
         new = old = match.group()
         if self.needs_decision():
             options = [('keep', 'k')]
@@ -139,6 +189,7 @@ class TypoRule:
                 pywikibot.warning(f'No replacement done in string "{old}"')
 
         if old != new:
+            self.stats.accepted += 1
             old_str = underscores(old.replace('\n', '\\n'))
             new_str = underscores(new.replace('\n', '\\n'))
             fragment = f'{old_str} → {new_str}'
@@ -146,33 +197,333 @@ class TypoRule:
                 replaced.append(fragment)
         return new
 
-    def apply(self, text, replaced=None):
+    def apply(self, text, replaced=None, spans=None):
+        '''
+        :param spans: spans of matches in the text if already found
+        '''
         if replaced is None:
             replaced = []
         hook = lambda match: self.summary_hook(match, replaced)
-        start = time.clock()
-        text = textlib.replaceExcept(
-            text, self.find, hook, self.exceptions, site=self.site)
-        finish = time.clock()
-        delta = finish - start
+        find = self.find
+        if spans is not None:
+            find = KnownMatches(find, text, spans)
+        start = time.perf_counter()
+        text = replace_except(
+            text, find, hook, self.exceptions, site=self.site)
+        delta = time.perf_counter() - start
+        self.stats.add_call(delta)
         self.longest = max(delta, self.longest)
         if delta > 5:
             pywikibot.warning(f'Slow typo rule "{self.find.pattern}" ({delta})')
         return text
 
 
+def required_literals(regex):
+    '''
+    Return strings one of which must occur in every match of the regex
+
+    An empty list means that no such strings could be found.
+    '''
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except re.error:
+        return []
+    # patterns compiled by RE2 do not report their inline flags
+    state = getattr(parsed, 'state', None) or parsed.pattern  # Python < 3.8
+    if state.flags & re.IGNORECASE:
+        return []
+    return _required_literals(parsed)
+
+
+def can_match_empty(pattern, flags=0):
+    '''Return whether the pattern can match an empty string somewhere'''
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except re.error:
+        return True
+    return parsed.getwidth()[0] == 0
+
+
+def _required_literals(items):
+    best = []
+    candidates = []
+    run = ''
+    for op, av in items:
+        if op == sre_parse.LITERAL:
+            run += chr(av)
+            continue
+        if op in (sre_parse.AT, sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+            continue  # zero-width, the run goes on
+        if op == sre_parse.SUBPATTERN and not av[1] & re.IGNORECASE:
+            if all(sub_op == sre_parse.LITERAL for sub_op, _ in av[-1]):
+                run += ''.join(chr(sub_av) for _, sub_av in av[-1])
+                continue
+
+        if run:
+            candidates.append([run])
+            run = ''
+        if op == sre_parse.SUBPATTERN:
+            add_flags, sub = av[1], av[-1]
+            if not add_flags & re.IGNORECASE:
+                candidates.append(_required_literals(sub))
+        elif op in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT,
+                    getattr(sre_parse, 'POSSESSIVE_REPEAT', None)):
+            if av[0] > 0:
+                candidates.append(_required_literals(av[2]))
+        elif op == sre_parse.BRANCH:
+            alternatives = [_required_literals(sub) for sub in av[1]]
+            if all(alternatives):
+                candidates.append(
+                    [lit for alt in alternatives for lit in alt])
+    if run:
+        candidates.append([run])
+
+    for literals in candidates:
+        if not literals:
+            continue
+        if not best or min(map(len, literals)) > min(map(len, best)):
+            best = literals
+    return best
+
+
+class LiteralAutomaton:
+
+    '''Aho-Corasick automaton telling which of many strings occur in text'''
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [set()]
+
+    def add(self, word, value):
+        state = 0
+        for char in word:
+            if char not in self.goto[state]:
+                self.goto[state][char] = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(set())
+            state = self.goto[state][char]
+        self.output[state].add(value)
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.output[child] |= self.output[self.fail[child]]
+
+    def search(self, text):
+        '''Return values of all added strings occurring in the text'''
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found |= output[state]
+        return found
+
+
+class TypoPrefilter:
+
+    '''Class telling which typo rules cannot match a text'''
+
+    def __init__(self, rules):
+        self.automaton = LiteralAutomaton()
+        self.ids = set()
+        for rule in rules:
+            for literal in rule.literals:
+                self.automaton.add(literal, rule.id)
+            if rule.literals:
+                self.ids.add(rule.id)
+        self.automaton.build()
+        self.checks = 0
+        self.hits = 0
+
+    def covers(self, rule):
+        return rule.id in self.ids
+
+    def search(self, text):
+        '''Return ids of covered rules which can match the text'''
+        return self.automaton.search(text)
+
+    def count(self, found):
+        '''Count a search which found the ids'''
+        self.checks += len(self.ids)
+        self.hits += len(found)
+
+    def candidates(self, text):
+        '''Return ids of covered rules which can match the text'''
+        found = self.search(text)
+        self.count(found)
+        return found
+
+    @property
+    def hit_ratio(self):
+        return self.hits / self.checks if self.checks else 0.0
+
+
+class TypoRuleSet:
+
+    '''Class applying many typo rules with a single scan of the text'''
+
+    # patterns which cannot be embedded into a larger expression
+    unsafeR = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?\(|\(\?[aiLmsux]+\)')
+
+    def __init__(self, rules, prefilter=None, watchdog=None):
+        if watchdog is not None and not watchdog.budget:
+            watchdog = None
+        self.rules = list(rules)
+        self.prefilter = prefilter
+        self.watchdog = watchdog
+        self.filtered = {}
+        self.guarded = []
+        self.scanned = []
+        self.unscanned = []
+        alternatives = []
+        for index, rule in enumerate(self.rules):
+            pattern = rule.pattern
+            if prefilter is not None and prefilter.covers(rule):
+                self.filtered[rule.id] = index
+            elif is_linear(rule.backend):
+                # searched on its own, it cannot blow up
+                self.unscanned.append(index)
+            elif watchdog is not None:
+                # the watchdog finds out whether it matches
+                self.guarded.append(index)
+            elif self.unsafeR.search(pattern) or can_match_empty(pattern, re.M):
+                self.unscanned.append(index)
+            else:
+                self.scanned.append(index)
+                alternatives.append(f'(?P<_{index}>{pattern})')
+        self.scanner = None
+        if alternatives:
+            try:
+                self.scanner = re.compile('|'.join(alternatives), re.M)
+            except re.error as exc:
+                pywikibot.warning(f'Cannot combine typo rules: {exc.msg}')
+                self.unscanned.extend(self.scanned)
+                self.unscanned.sort()
+                self.scanned = []
+
+    def __len__(self):
+        return len(self.rules)
+
+    def prefiltered(self, text):
+        '''Return ids the prefilter finds for the text without counting'''
+        return self.prefilter.search(text) if self.filtered else set()
+
+    def scan(self, text, prefiltered=None):
+        '''
+        Return indices of all rules which can match the text
+
+        :param prefiltered: result of prefiltered() for the text, the
+            caller counts it with the prefilter then
+        '''
+        found = {index for index in self.unscanned
+                 if self.rules[index].find.search(text)}
+        found.update(self.guarded)
+        if self.filtered:
+            if prefiltered is None:
+                prefiltered = self.prefilter.candidates(text)
+            found.update(self.filtered[rule_id]
+                         for rule_id in prefiltered
+                         if rule_id in self.filtered)
+        if self.scanner is None:
+            return found
+
+        pos = 0
+        # the scanner clamps the position, so stop at the end explicitly
+        while pos <= len(text) and (match := self.scanner.search(text, pos)):
+            pos = match.start()
+            first = int(match.lastgroup[1:])
+            found.add(first)
+            # the alternation hides the rules after the first one
+            for index in self.scanned:
+                if index > first and index not in found:
+                    if self.rules[index].find.match(text, pos):
+                        found.add(index)
+            pos += 1
+        return found
+
+    def apply(self, text, replaced=None, *, title=None, skip=None,
+              deadline=None, prepared=None):
+        '''
+        Apply all rules to the text like applying one rule after another
+
+        :param title: skip rules which match this title
+        :param skip: callable telling whether a rule should be skipped
+        :param deadline: do not apply more rules after this time
+        :param prepared: results computed ahead for the text
+        '''
+        if replaced is None:
+            replaced = []
+        if prepared is not None and text is prepared.text:
+            pending = prepared.pending
+            if self.filtered:
+                self.prefilter.count(prepared.prefiltered)
+        else:
+            pending = self.scan(text)
+        for index, rule in enumerate(self.rules):
+            if index not in pending:
+                continue
+            if title is not None and rule.find.search(title):
+                rule.stats.title_skips += 1
+                continue
+            if skip is not None and skip(rule):
+                continue
+            spans = None
+            if self.watchdog and not is_linear(rule.backend):
+                if prepared is not None:
+                    spans = prepared.check(rule, text, self.watchdog, title)
+                else:
+                    spans = self.watchdog.check(rule, text, title)
+                if not spans:
+                    continue  # exceeded the budget or has no match
+
+            new_text = rule.apply(text, replaced, spans)
+            if new_text != text:
+                text = new_text
+                # previous replacements could have made or broken matches
+                pending = self.scan(text)
+            if deadline is not None and time.time() > deadline:
+                pywikibot.warning('Typos exceeded the time limit, skipping')
+                break
+        return text
+
+
 class TyposLoader:
 
     top_id = 0
+    # increased when cached rules have to be parsed again
+    cache_version = 3
 
     '''Class loading and holding typo rules'''
 
     def __init__(self, site, *, allrules=False, typospage=None,
-                 whitelistpage=None):
+                 whitelistpage=None, quarantine=None, cache=True):
         self.site = site
         self.load_all = allrules
         self.typos_page_name = typospage
         self.whitelist_page_name = whitelistpage
+        if quarantine is None:
+            quarantine = TypoQuarantine()
+        self.quarantine = quarantine
+        self.cache_path = config.datafilepath('typos-rules.json') if cache else None
+
+    def getTyposPage(self):
+        if self.typos_page_name is None:
+            self.typos_page_name = 'Wikipedie:WPCleaner/Typo'
+
+        return pywikibot.Page(self.site, self.typos_page_name)
 
     def getWhitelistPage(self):
         if self.whitelist_page_name is None:
@@ -180,20 +531,41 @@ class TyposLoader:
 
         return pywikibot.Page(self.site, self.whitelist_page_name)
 
-    def loadTypos(self):
-        pywikibot.info('Loading typo rules')
-        self.typoRules = []
-
-        if self.typos_page_name is None:
-            self.typos_page_name = 'Wikipedie:WPCleaner/Typo'
-        typos_page = pywikibot.Page(self.site, self.typos_page_name)
-        if not typos_page.exists():
-            # todo: feedback
+    def load_cache(self, page):
+        '''Return data cached for the latest revision of the page'''
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path, encoding='utf-8') as file:
+                cache = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+        entry = cache.get(f'{self.site}:{page.title()}')
+        if (entry and entry['revision'] == page.latest_revision_id
+                and entry.get('version') == self.cache_version):
+            return entry['data']
+        return None
+
+    def save_cache(self, page, data):
+        if not self.cache_path:
             return
-
+        try:
+            with open(self.cache_path, encoding='utf-8') as file:
+                cache = json.load(file)
+        except (FileNotFoundError, ValueError):
+            cache = {}
+        cache[f'{self.site}:{page.title()}'] = {
+            'revision': page.latest_revision_id,
+            'version': self.cache_version,
+            'data': data,
+        }
+        with open(self.cache_path, 'w', encoding='utf-8') as file:
+            json.dump(cache, file, ensure_ascii=False)
+
+    def parseTypos(self, text):
         text = textlib.removeDisabledParts(
-            typos_page.text, include=['nowiki'], site=self.site)
-        load_all = self.load_all is True
+            text, include=['nowiki'], site=self.site)
+        rules = []
         for template, fielddict in textlib.extract_templates_and_params(
                 text, remove_disabled_parts=False, strip=False):
             if template.lower() == 'typo':
@@ -205,21 +577,62 @@ class TyposLoader:
                     if 'fixed-width' not in exc.message:
                         pywikibot.warning(f"Invalid {exc.aspect} {fielddict['1']}: {exc.message}")
                 else:
-                    rule.id = self.top_id
-                    # fixme: cvar or ivar?
-                    self.top_id += 1
-                    if load_all or not rule.needs_decision():
-                        self.typoRules.append(rule)
+                    rule.literals = required_literals(rule.find)
+                    rules.append(rule)
+        return rules
+
+    def loadTypos(self):
+        pywikibot.info('Loading typo rules')
+        self.typoRules = []
+        self.prefilter = None
+
+        typos_page = self.getTyposPage()
+        if not typos_page.exists():
+            # todo: feedback
+            return
+
+        cached = self.load_cache(typos_page)
+        if cached is not None:
+            rules = [TypoRule.from_dict(data) for data in cached]
+            pywikibot.info('Typo rules loaded from the cache')
+        else:
+            rules = self.parseTypos(typos_page.text)
+            self.save_cache(typos_page, [rule.to_dict() for rule in rules])
+
+        load_all = self.load_all is True
+        quarantined = 0
+        for rule in rules:
+            if rule.pattern in self.quarantine:
+                quarantined += 1
+                continue
+            rule.id = self.top_id
+            rule.site = self.site
+            # fixme: cvar or ivar?
+            self.top_id += 1
+            if load_all or not rule.needs_decision():
+                self.typoRules.append(rule)
 
         pywikibot.info(f'{len(self.typoRules)} typo rules loaded')
+        backends = count_backends(rule.backend for rule in self.typoRules)
+        pywikibot.info('Regex backends: ' + ', '.join(
+            f'{count} on {backend}' for backend, count in sorted(
+                backends.items())))
+        if quarantined:
+            pywikibot.info(f'{quarantined} quarantined rules skipped')
+        self.prefilter = TypoPrefilter(self.typoRules)
+        pywikibot.info(f'{len(self.prefilter.ids)} of them can be prefiltered')
         return self.typoRules
 
     def loadWhitelist(self):
         self.whitelist = []
         self.fp_page = self.getWhitelistPage()
         if self.fp_page.exists():
-            self.whitelist.extend(
-                match[1].strip()
-                for match in re.finditer(r'\[\[([^]|]+)\]\]', self.fp_page.text)
-            )
+            cached = self.load_cache(self.fp_page)
+            if cached is None:
+                cached = [
+                    match[1].strip() for match in re.finditer(
+                        r'\[\[([^]|]+)\]\]', self.fp_page.text)
+                ]
+                self.save_cache(self.fp_page, cached)
+            self.whitelist.extend(cached)
         return self.whitelist
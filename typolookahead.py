@@ -0,0 +1,102 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from protected_regions import ProtectedRegionsCache
+from typoloader import TypoRule
+from typowatchdog import RegexWatchdog
+
+
+class PreparedPage:
+
+    '''Results of typo rules computed ahead for a page text'''
+
+    def __init__(self, text):
+        self.text = text
+        self.spans = {}
+        self.pending = None
+        self.prefiltered = set()
+        self.regions = ProtectedRegionsCache()
+
+    def check(self, rule, text, watchdog, title=None):
+        '''Return spans of matches of the rule in the text'''
+        if text is self.text and rule.id in self.spans:
+            spans = self.spans[rule.id]
+            if spans is None and watchdog.quarantine is not None:
+                # not recorded by the thread which found it out
+                watchdog.quarantine.record(rule.find.pattern, title)
+            return spans
+        return watchdog.check(rule, text, title)
+
+
+class TypoLookahead:
+
+    '''
+    Class preparing upcoming pages in a background thread
+
+    While the operator decides about a match, the next pages are
+    already scanned: matches of their rules are found and protected
+    regions are found, so the next question comes without a delay.
+    Statistics of the rules are only updated once a prepared page is
+    used in the main thread.
+    '''
+
+    def __init__(self, ruleset, depth=3, *, site=None, budget=5):
+        self.ruleset = ruleset
+        self.depth = depth
+        self.site = site
+        # the worker of the bot must not be shared with the thread,
+        # rules exceeding the budget are quarantined by PreparedPage
+        self.watchdog = RegexWatchdog(budget)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.ahead = deque()  # (page, rules, future)
+        self.skipped = set()
+
+    def skip(self, rule_ids):
+        '''Drop any work not done yet for these rules'''
+        self.skipped.update(rule_ids)
+
+    def prepare(self, text, title, rules):
+        prepared = PreparedPage(text)
+        prepared.regions.get(text, TypoRule.exceptions, self.site)
+        prepared.prefiltered = self.ruleset.prefiltered(text)
+        prepared.pending = self.ruleset.scan(text, prepared.prefiltered)
+        if self.ruleset.watchdog is not None:
+            rules = rules + [self.ruleset.rules[index]
+                             for index in sorted(prepared.pending)]
+        for rule in rules:
+            if rule.id in self.skipped or rule.id in prepared.spans:
+                continue
+            if rule.find.search(title):
+                continue
+            prepared.spans[rule.id] = self.watchdog.check(rule, text, title)
+        return prepared
+
+    def iterate(self, items):
+        '''
+        Yield (page, rules, prepared) going depth pages ahead
+
+        Pages whose rules have all been skipped meanwhile are dropped.
+        '''
+        ahead = self.ahead
+        items = iter(items)
+        while True:
+            for page, rules in items:
+                future = self.executor.submit(
+                    self.prepare, page.text, page.title(), rules)
+                ahead.append((page, rules, future))
+                if len(ahead) > self.depth:
+                    break
+            if not ahead:
+                return
+            page, rules, future = ahead.popleft()
+            rules = [rule for rule in rules if rule.id not in self.skipped]
+            if not rules:
+                future.cancel()
+                continue
+            yield page, rules, future.result()
+
+    def close(self):
+        for _, _, future in self.ahead:
+            future.cancel()
+        self.executor.shutdown(wait=True)
+        self.watchdog.close()
@@ -1,10 +1,19 @@
 #!/usr/bin/python
 import time
 
+from collections import defaultdict, deque
+
 import pywikibot
 from pywikibot import pagegenerators
-
-from typoloader import TyposLoader
+from pywikibot.tools.itertools import itergroup
+
+from protected_regions import default_cache
+from typoloader import TypoRuleSet, TyposLoader
+from typolookahead import TypoLookahead
+from typostats import (
+    aggregate_history, load_history, save_history, TypoScheduler
+)
+from typowatchdog import RegexWatchdog
 from wikitext import WikitextFixingBot
 
 
@@ -15,25 +24,35 @@ class TypoBot(WikitextFixingBot):
 
     Supported parameters:
     * -allrules - use if you want to load rules that need user's decision
-    * -offset:# - what typo rule do you want to start from
+    * -budget:# - how many seconds can a rule take on a page (0 = no limit)
+    * -lookahead:# - how many pages to prepare while waiting for decisions
+    * -offset:# - what typo rule do you want to start from, rules then
+      go in the order of the page instead of the order by their history
     * -quick - use if you want the bot to focus on the current rule,
       ie. skip the page if the rule couldn't be applied
+    * -sampling:# - what percentage of rules with poor history to run
     * -threshold:# - skip rule when loaded/replaced ratio gets over #
     * -typospage: - what page do you want to load typo rules from
     * -whitelistpage: - what page holds pages which should be skipped
+    * -window:# - for how many rules to search at once, each found page
+      is then loaded and fixed once for all of them
     '''
 
-    def __init__(self, generator, *, offset=0, **kwargs):
+    def __init__(self, generator, *, offset=None, **kwargs):
         self.available_options.update({
             'allrules': False,
+            'budget': 5,
+            'lookahead': 3,
             'quick': False,
+            'sampling': 20,
             'threshold': 10,
             'typospage': None,
             'whitelistpage': None,
+            'window': 20,
         })
         kwargs['typos'] = False
         self.own_generator = not bool(generator)
-        self.generator = self.make_generator() if self.own_generator else generator
+        self.generator = self.iter_prepared() if self.own_generator else generator
         super().__init__(**kwargs)
         self.offset = offset
 
@@ -43,52 +62,132 @@ class TypoBot(WikitextFixingBot):
             typospage=self.opt['typospage'],
             whitelistpage=self.opt['whitelistpage'])
         self.typoRules = loader.loadTypos()
+        self.prefilter = loader.prefilter
+        self.watchdog = RegexWatchdog(self.opt['budget'], loader.quarantine)
+        self.ruleset = TypoRuleSet(
+            self.typoRules, self.prefilter, self.watchdog)
+        self.lookahead = TypoLookahead(
+            self.ruleset, self.opt['lookahead'], site=self.site,
+            budget=self.opt['budget'])
+        self.prepared = None
+        # pages in the order they were yielded and their windows
+        self.page_windows = deque()
+        # windows whose pages have all been yielded, to be reported
+        # once those pages have been treated
+        self.finished_windows = deque()
         self.fp_page = loader.getWhitelistPage()
         self.whitelist = loader.loadWhitelist()
+        self.scheduler = TypoScheduler(
+            aggregate_history(load_history(site=self.site)),
+            threshold=self.opt['threshold'],
+            sampling=self.opt['sampling'] / 100)
 
-    @property
-    def is_rule_accurate(self):
+    def is_rule_accurate(self, rule):
         threshold = self.opt['threshold']
+        processed = rule.stats.pages
         return (
-            self.processed < threshold
-            or self.processed / threshold < self.replaced
+            processed < threshold
+            or processed / threshold < rule.stats.fixed_pages
         )
 
-    def make_generator(self):
-        for i, rule in enumerate(self.typoRules[:]):
-            if self.offset > i:
+    def active_rules(self, title):
+        return self.accurate_rules(self.page_rules[title])
+
+    def accurate_rules(self, rules):
+        '''Return the rules which were not skipped nor found inaccurate'''
+        active = []
+        for rule in rules:
+            if rule.id in self.skipped_rules:
                 continue
-            if rule.query is None:
+            if not self.is_rule_accurate(rule):
+                pywikibot.info(
+                    f'Skipped inefficient query "{rule.query}" '
+                    f'({rule.stats.fixed_pages}/{rule.stats.pages})')
+                self.skipped_rules.add(rule.id)
                 continue
+            active.append(rule)
+        return active
 
-            # todo: if not allrules:...
-            self.offset = i
-            pywikibot.info(f'\nQuery: "{rule.query}"')
-            old_max = rule.longest
-            rule.longest = 0.0
-            self.current_rule = rule
-            self.skip_rule = False
-            self.processed = self.replaced = 0
-            for page in self.site.search(rule.query, namespaces=[0]):
-                if self.skip_rule:
-                    break
-                yield page
-                if not self.is_rule_accurate:
-                    pywikibot.info(
-                        f'Skipped inefficient query "{rule.query}" '
-                        f'({self.replaced}/{self.processed}')
-                    break
-            else:
-                if self.processed < 1:
+    def make_generator(self):
+        self.skipped_rules = set()
+        self.current_rules = []
+        self.changing_rules = []
+        rules = [(i, rule) for i, rule in enumerate(self.typoRules[:])
+                 if i >= (self.offset or 0) and rule.query is not None]
+        if self.offset is None:
+            indices = {rule.id: i for i, rule in rules}
+            rules = [(indices[rule.id], rule) for rule in
+                     self.scheduler.order([rule for _, rule in rules])]
+        # todo: if not allrules:...
+        for number, window in enumerate(
+                itergroup(rules, self.opt['window'])):
+            if self.offset is not None:
+                self.offset = window[0][0]
+            window = [rule for _, rule in window]
+            old_max = {}
+            pages = {}
+            self.page_rules = defaultdict(list)
+            for rule in window:
+                pywikibot.info(f'\nQuery: "{rule.query}"')
+                old_max[rule.id] = rule.longest
+                rule.longest = 0.0
+                start = time.perf_counter()
+                for page in self.site.search(rule.query, namespaces=[0]):
+                    title = page.title()
+                    pages.setdefault(title, page)
+                    self.page_rules[title].append(rule)
+                    rule.stats.search_hits += 1
+                rule.stats.search_time += time.perf_counter() - start
+
+            pywikibot.info(f'{len(pages)} pages found for {len(window)} '
+                           'queries')
+            # each page is loaded once for all rules which found it
+            for page in pagegenerators.PreloadingGenerator(
+                    page for title, page in pages.items()
+                    if self.active_rules(title)):
+                self.current_rules = self.active_rules(page.title())
+                if self.current_rules:
+                    self.page_windows.append((page, number))
+                    yield page
+
+            self.finished_windows.append((number, window, old_max))
+
+    def report_windows(self, before=None):
+        '''Report finished windows up to the given one (excluded)'''
+        while self.finished_windows and (
+                before is None or self.finished_windows[0][0] < before):
+            _, window, old_max = self.finished_windows.popleft()
+            for rule in window:
+                processed = rule.stats.pages
+                if rule.id in self.skipped_rules:
+                    pass
+                elif processed < 1:
                     pywikibot.info(f'No results from query "{rule.query}"')
                 else:
-                    percent = (self.replaced / self.processed) * 100
+                    percent = (rule.stats.fixed_pages / processed) * 100
                     pywikibot.info(
-                        f'{percent:.f}% accuracy of query "{rule.query}"')
+                        f'{percent:.1f}% accuracy of query "{rule.query}"')
 
-            if self.processed > 0:
-                pywikibot.info(f'Longest match: {rule.longest}s')
-            rule.longest = max(old_max, rule.longest)
+                if processed > 0:
+                    pywikibot.info(
+                        f'Longest match of "{rule.query}": {rule.longest}s')
+                rule.longest = max(old_max[rule.id], rule.longest)
+
+    def iter_prepared(self):
+        pages = self.make_generator()
+        if self.opt['always'] or not self.opt['lookahead']:
+            yield from pages
+            return
+
+        items = ((page, self.current_rules) for page in pages)
+        for page, rules, prepared in self.lookahead.iterate(items):
+            # the generator has gone ahead, check the rules again with
+            # the statistics of the pages treated since
+            self.current_rules = self.accurate_rules(rules)
+            if not self.current_rules:
+                continue
+            self.prepared = prepared
+            yield page
 
     def save_false_positive(self, page):
         link = page.title(as_link=True)
@@ -101,17 +200,32 @@ class TypoBot(WikitextFixingBot):
             pywikibot.warning(f'Skipped {page} because it is whitelisted')
             return True
 
-        if self.own_generator and self.current_rule.find.search(page.title()):
-            pywikibot.warning(
-                f'Skipped {page} because the rule matches the title')
-            return True
+        if self.own_generator:
+            rules = []
+            for rule in self.current_rules:
+                if rule.find.search(page.title()):
+                    rule.stats.title_skips += 1
+                else:
+                    rules.append(rule)
+            self.current_rules = rules
+            if not rules:
+                pywikibot.warning(
+                    f'Skipped {page} because the rules match the title')
+                return True
 
         return super().skip_page(page)
 
     def init_page(self, page):
         out = super().init_page(page)
         if self.own_generator:
-            self.processed += 1
+            # pages are treated in the order they were yielded, so the
+            # windows before this page's one have been treated
+            while self.page_windows and self.page_windows[0][0] is not page:
+                self.page_windows.popleft()
+            if self.page_windows:
+                self.report_windows(before=self.page_windows.popleft()[1])
+            for rule in self.current_rules:
+                rule.stats.pages += 1
         return out
 
     def treat_page(self):
@@ -120,29 +234,37 @@ class TypoBot(WikitextFixingBot):
         done_replacements = []
         quickly = self.opt['quick'] is True
         start = time.time()
+        prepared = self.prepared if self.own_generator else None
+        if prepared is not None and prepared.text is text:
+            default_cache.adopt(prepared.regions)
         if self.own_generator:
-            text = self.current_rule.apply(page.text, done_replacements)
-            if page.text == text:
-                if quickly:
-                    pywikibot.info('Typo not found, not fixing another '
-                                   'typos in quick mode')
-                    return
-            else:
-                self.replaced += 1
-
-        for rule in self.typoRules:
-            if self.own_generator and rule == self.current_rule:  # __eq__
-                continue
-            if rule.find.search(page.title()):
-                continue
-            if quickly and rule.needs_decision():
-                continue
-
-            text = rule.apply(text, done_replacements)
-            stop = time.time()
-            if quickly and stop - start > 15:
-                pywikibot.warning('Other typos exceeded 15s, skipping')
-                break
+            self.changing_rules = []
+            for rule in self.current_rules:
+                if prepared is not None:
+                    spans = prepared.check(
+                        rule, text, self.watchdog, page.title())
+                else:
+                    spans = self.watchdog.check(rule, text, page.title())
+                if not spans:
+                    continue
+                new_text = rule.apply(text, done_replacements, spans)
+                if new_text != text:
+                    text = new_text
+                    rule.stats.fixed_pages += 1
+                    self.changing_rules.append(rule)
+            if quickly and not self.changing_rules:
+                pywikibot.info('Typo not found, not fixing another '
+                               'typos in quick mode')
+                return
+
+        def skip(rule):
+            if self.own_generator and rule in self.current_rules:  # __eq__
+                return True
+            return quickly and rule.needs_decision()
+
+        text = self.ruleset.apply(
+            text, done_replacements, title=page.title(), skip=skip,
+            deadline=start + 15 if quickly else None, prepared=prepared)
 
         self.put_current(
             text, summary=f"oprava překlepů: {', '.join(done_replacements)}"
@@ -166,7 +288,10 @@ class TypoBot(WikitextFixingBot):
             return False
 
         if choice == 's':
-            self.skip_rule = True
+            skipped = {rule.id for rule in
+                       self.changing_rules or self.current_rules}
+            self.skipped_rules.update(skipped)
+            self.lookahead.skip(skipped)
             return False
 
         if choice == 'b':
@@ -186,14 +311,24 @@ class TypoBot(WikitextFixingBot):
         return True
 
     def teardown(self):
+        if self.own_generator:
+            self.report_windows()
         rules = sorted(
             (rule for rule in self.typoRules if not rule.needs_decision()),
             key=lambda rule: rule.longest, reverse=True)[:3]
         pywikibot.info('\nSlowest autonomous rules:')
         for i, rule in enumerate(rules, start=1):
-            pywikibot.info(f'{i}. "{rule.find.pattern}" - {rule.longest}')
-        if self.own_generator:
+            pywikibot.info(f'{i}. "{rule.pattern}" - {rule.longest}')
+        if self.prefilter and self.prefilter.checks:
+            pywikibot.info(
+                f'\nPrefilter hit ratio: {self.prefilter.hit_ratio:.2%} '
+                f'({self.prefilter.hits}/{self.prefilter.checks})')
+        if self.own_generator and self.offset is not None:
             pywikibot.info(f'\nCurrent offset: {self.offset}\n')
+        self.lookahead.close()
+        self.watchdog.close()
+        path = save_history(self.typoRules, self.site)
+        pywikibot.info(f'Rule statistics saved to {path}')
         super().teardown()
 
 
@@ -0,0 +1,160 @@
+import json
+import math
+import random
+import time
+
+import pywikibot
+
+from pywikibot import config
+
+
+class TypoRuleStats:
+
+    '''Profiling data of one typo rule'''
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.durations = []
+        self.matches = 0
+        self.accepted = 0
+        self.title_skips = 0
+        self.search_hits = 0
+        self.search_time = 0.0
+        self.pages = 0
+        self.fixed_pages = 0
+
+    def add_call(self, delta):
+        self.calls += 1
+        self.total += delta
+        self.durations.append(delta)
+
+    def percentile(self, percent):
+        if not self.durations:
+            return 0.0
+        durations = sorted(self.durations)
+        index = max(0, math.ceil(len(durations) * percent / 100) - 1)
+        return durations[index]
+
+    @property
+    def max(self):
+        return max(self.durations, default=0.0)
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'total': self.total,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'max': self.max,
+            'matches': self.matches,
+            'accepted': self.accepted,
+            'title_skips': self.title_skips,
+            'search_hits': self.search_hits,
+            'search_time': self.search_time,
+            'pages': self.pages,
+            'fixed_pages': self.fixed_pages,
+        }
+
+
+def history_path():
+    return config.datafilepath('typos-history.jsonl')
+
+
+def save_history(rules, site, path=None):
+    '''Append statistics of used rules as one line of the history'''
+    record = {
+        'time': int(time.time()),
+        'site': str(site),
+        'rules': {rule.pattern: rule.stats.to_dict() for rule in rules
+                  if rule.stats.calls or rule.stats.title_skips
+                  or rule.stats.search_hits},
+    }
+    path = path or history_path()
+    with open(path, 'a', encoding='utf-8') as file:
+        file.write(json.dumps(record, ensure_ascii=False) + '\n')
+    return path
+
+
+def load_history(path=None, site=None):
+    path = path or history_path()
+    try:
+        file = open(path, encoding='utf-8')
+    except FileNotFoundError:
+        return
+    with file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                pywikibot.warning(f'Skipped broken line in {path}')
+                continue
+            if site is None or record['site'] == str(site):
+                yield record
+
+
+def aggregate_history(records):
+    '''Sum up statistics of each rule over all runs'''
+    summed = ('calls', 'total', 'matches', 'accepted', 'title_skips',
+              'search_hits', 'search_time', 'pages', 'fixed_pages')
+    totals = {}
+    for record in records:
+        for pattern, data in record['rules'].items():
+            entry = totals.setdefault(pattern, dict.fromkeys(summed, 0))
+            entry.setdefault('runs', 0)
+            entry.setdefault('p95', 0.0)
+            entry.setdefault('max', 0.0)
+            entry['runs'] += 1
+            for key in summed:
+                entry[key] += data.get(key, 0)
+            entry['p95'] = max(entry['p95'], data['p95'])
+            entry['max'] = max(entry['max'], data['max'])
+    return totals
+
+
+class TypoScheduler:
+
+    '''
+    Class ordering typo rules by expected fixes per second
+
+    The expectation is based on the history of previous runs. Rules
+    without history go first, rules which fixed too few of the pages
+    they found are demoted and only a sample of them is run.
+    '''
+
+    page_cost = 2.0  # rough time of loading and reviewing a page
+    min_pages = 20
+
+    def __init__(self, totals, *, threshold=10, sampling=0.2):
+        self.totals = totals
+        self.threshold = threshold
+        self.sampling = sampling
+
+    def expected_rate(self, rule):
+        data = self.totals.get(rule.pattern)
+        if not data or not data['search_hits']:
+            return math.inf
+        cost = (data['search_time'] + data['total']
+                + data['pages'] * self.page_cost)
+        return data['fixed_pages'] / cost if cost else math.inf
+
+    def is_poor(self, rule):
+        data = self.totals.get(rule.pattern)
+        if not data or data['pages'] < self.min_pages:
+            return False
+        return data['pages'] / self.threshold >= data['fixed_pages']
+
+    def order(self, rules):
+        good = []
+        poor = []
+        for rule in rules:
+            if not self.is_poor(rule):
+                good.append(rule)
+            elif random.random() < self.sampling:
+                poor.append(rule)
+        dropped = sum(map(self.is_poor, rules)) - len(poor)
+        if dropped:
+            pywikibot.info(f'{dropped} rules with poor history not sampled')
+        good.sort(key=self.expected_rate, reverse=True)
+        poor.sort(key=self.expected_rate, reverse=True)
+        return good + poor
@@ -0,0 +1,122 @@
+import json
+import multiprocessing
+import os
+import re
+
+import pywikibot
+
+from pywikibot import config
+
+from regex_backends import is_linear
+
+
+def _worker(conn):
+    text = ''
+    compiled = {}
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        if message[0] == 'text':
+            text = message[1]
+        elif message[0] == 'check':
+            pattern, flags = message[1:]
+            if (pattern, flags) not in compiled:
+                compiled[pattern, flags] = re.compile(pattern, flags)
+            conn.send([match.span()
+                       for match in compiled[pattern, flags].finditer(text)])
+
+
+class TypoQuarantine:
+
+    '''Persisted list of typo rules which repeatedly exceeded the budget'''
+
+    limit = 3
+
+    def __init__(self, path=None):
+        self.path = path or config.datafilepath('typos-quarantine.json')
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                self.data = json.load(file)
+        except FileNotFoundError:
+            self.data = {}
+        except ValueError as exc:
+            # e.g. the bot was killed while saving it
+            pywikibot.warning(f'Cannot read {self.path}, starting anew: {exc}')
+            self.data = {}
+
+    def __contains__(self, pattern):
+        return self.data.get(pattern, {}).get('timeouts', 0) >= self.limit
+
+    def record(self, pattern, title=None):
+        entry = self.data.setdefault(pattern, {'timeouts': 0, 'pages': []})
+        entry['timeouts'] += 1
+        if title and title not in entry['pages']:
+            entry['pages'].append(title)
+        if pattern in self:
+            pywikibot.warning(f'Typo rule "{pattern}" has been quarantined')
+        self.save()
+
+    def save(self):
+        temp = f'{self.path}.tmp'
+        with open(temp, 'w', encoding='utf-8') as file:
+            json.dump(self.data, file, ensure_ascii=False, indent=1)
+        os.replace(temp, self.path)
+
+
+class RegexWatchdog:
+
+    '''
+    Class running regexes in a separate process which can be killed
+
+    A rule is first tried in the worker process. If it does not finish
+    within the budget, the worker is killed and the rule is reported
+    as unsafe for the text.
+    Spans of the matches it found are returned, so that they do not
+    have to be searched for again.
+    '''
+
+    def __init__(self, budget=5, quarantine=None):
+        self.budget = budget
+        self.quarantine = quarantine
+        self.process = None
+        self.text = None
+
+    def start(self):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_worker, args=(child_conn,), daemon=True)
+        self.process.start()
+        self.text = None
+
+    def close(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def check(self, rule, text, title=None):
+        '''
+        Return spans of matches of the rule in the text
+
+        Return None if it did not finish within the budget.
+        '''
+        if not self.budget or is_linear(rule.backend):
+            return [match.span() for match in rule.find.finditer(text)]
+        if self.process is None:
+            self.start()
+        if text is not self.text:
+            self.conn.send(('text', text))
+            self.text = text
+        self.conn.send(('check', rule.find.pattern, rule.find.flags))
+        if self.conn.poll(self.budget):
+            return self.conn.recv()
+
+        self.close()
+        pywikibot.warning(
+            f'Typo rule "{rule.find.pattern}" exceeded {self.budget}s, '
+            'skipping it')
+        if self.quarantine is not None:
+            self.quarantine.record(rule.find.pattern, title)
+        return None
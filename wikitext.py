@@ -1,13 +1,26 @@
 #!/usr/bin/python
+import difflib
+import json
+import multiprocessing
+import os
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from itertools import chain
 from operator import methodcaller
 
 import pywikibot
+import requests
 
-from pywikibot import pagegenerators
+from pywikibot import config, pagegenerators
 from pywikibot.bot import SingleSiteBot, ExistingPageBot
+from pywikibot.comms import http
+from pywikibot.tools.itertools import itergroup
+from pywikibot.xmlreader import XmlDump
 
 from custome_fixes import all_fixes
+from tools import fork_context
+from wikitext_document import WikitextDocument
 
 
 class WikitextFixingBot(SingleSiteBot, ExistingPageBot):
@@ -21,24 +34,33 @@ class WikitextFixingBot(SingleSiteBot, ExistingPageBot):
 
     You can enable each fix by using its name as a command line argument
     or all fixes using -all (then, each used fix is excluded).
+
+    With -processes:#, fixes which only need the text run in worker
+    processes while the next pages are fetched and the previous saved.
+    The workers are forked, so this is not available on Windows.
+
+    With -xml:<dump> or -dir:<directory>, pages are taken from there
+    and only diffs and statistics are written to -dryrun:<directory>.
+    Only fixes which can run in worker processes are used then.
     '''
 
     def __init__(self, **kwargs):
-        do_all = kwargs.pop('all', False) is True
+        demanded = self.demanded_fixes(kwargs)
+        kwargs.pop('all', None)
         self.fixes = []
         for fix, cls in all_fixes.items():
-            if do_all:
-                demand = fix not in kwargs
-                kwargs.pop(fix, None)
-            else:
-                demand = bool(kwargs.pop(fix, False))
-            if demand:
+            kwargs.pop(fix, None)
+            if fix in demanded:
                 options = {opt: kwargs.pop(opt) for opt in cls.options.keys() if opt in kwargs}
                 self.fixes.append(cls(**options))
 
         self.fixes.sort(key=lambda fix: fix.order)
 
+        self.available_options.update({
+            'processes': 0,
+        })
         super().__init__(**kwargs)
+        self._prepared = None
         for fix in self.fixes:
             fix.site = self.site
         if not self.generator:
@@ -46,11 +68,105 @@ class WikitextFixingBot(SingleSiteBot, ExistingPageBot):
             self.generator = pagegenerators.PreloadingGenerator(
                 chain.from_iterable(map(methodcaller('generator'), self.fixes)))
 
+    @staticmethod
+    def demanded_fixes(options):
+        '''Return classes of the fixes demanded by the options by keys'''
+        if options.get('all', False) is True:
+            return {fix: cls for fix, cls in all_fixes.items()
+                    if fix not in options}
+        return {fix: cls for fix, cls in all_fixes.items()
+                if options.get(fix, False)}
+
+    def setup(self):
+        super().setup()
+        if (self.opt.processes
+                and type(self).treat_page is WikitextFixingBot.treat_page):
+            split = len(self.fixes)
+            while split > 0 and self.fixes[split - 1].parallel:
+                split -= 1
+            if split == len(self.fixes):
+                pywikibot.warning('None of the last fixes can run in worker '
+                                  'processes, running in one process')
+            elif fork_context() is None:
+                pywikibot.warning('Worker processes cannot be forked here, '
+                                  'running in one process')
+            else:
+                processes = self.opt.processes
+                if processes is True:
+                    processes = multiprocessing.cpu_count()
+                pywikibot.info(
+                    f"Running {', '.join(fix.key for fix in self.fixes[split:])} "
+                    f'in {processes} processes')
+                # the generator may start threads, fork before that
+                executor = self.start_workers(self.fixes[split:], processes)
+                self.generator = self.pipelined(
+                    self.generator, split, executor, processes)
+
+    def start_workers(self, fixes, processes):
+        '''Return an executor with forked processes running the fixes'''
+        # the workers inherit site data instead of each loading it
+        self.site.siteinfo.get('namespaces')
+        self.site.siteinfo.get('magicwords')
+        executor = ProcessPoolExecutor(
+            processes, fork_context(), initializer=_init_pipeline_worker,
+            initargs=(self, fixes))
+        # processes are forked once the first task is submitted
+        executor.submit(int).result()
+        return executor
+
+    def pipelined(self, generator, split, executor, processes):
+        '''
+        Yield pages with fixes applied ahead in worker processes
+
+        Fixes before the split (those which need the network or
+        the operator) run here, the rest of the chain in the workers.
+        Pages are yielded in the order of the generator.
+        '''
+        local = self.fixes[:split]
+        pending = deque()
+        try:
+            for page in generator:
+                if not page.exists() or page.isRedirectPage():
+                    pending.append((page, None, None, None, None))
+                else:
+                    old_text = page.text
+                    summaries = []
+                    callbacks = self.applyFixes(page, summaries, local)
+                    future = executor.submit(
+                        _apply_fixes, page.title(), page.text)
+                    pending.append(
+                        (page, old_text, summaries, callbacks, future))
+
+                while len(pending) > 2 * processes:
+                    yield self._finish_prepared(*pending.popleft())
+
+            while pending:
+                yield self._finish_prepared(*pending.popleft())
+        finally:
+            for *_, future in pending:
+                if future is not None:
+                    future.cancel()
+            executor.shutdown()
+
+    def _finish_prepared(self, page, old_text, summaries, callbacks, future):
+        if future is not None:
+            page.text, more = future.result()
+            summaries.extend(more)
+        if old_text is None:
+            self._prepared = None
+        else:
+            self._prepared = (page, old_text, summaries, callbacks)
+        return page
+
     def treat_page(self):
         summaries = []
         page = self.current_page
-        old_text = page.text
-        callbacks = self.applyFixes(page, summaries)
+        if self._prepared is not None and self._prepared[0] is page:
+            _, old_text, summaries, callbacks = self._prepared
+            self._prepared = None
+        else:
+            old_text = page.text
+            callbacks = self.applyFixes(page, summaries)
         if not summaries:
             pywikibot.info('No replacements worth saving')
             return
@@ -61,10 +177,19 @@ class WikitextFixingBot(SingleSiteBot, ExistingPageBot):
         self._save_page(page, page.save, callback=callback,
                         summary='; '.join(summaries))
 
-    def applyFixes(self, page, summaries=[]):
+    def applyFixes(self, page, summaries=[], fixes=None, changed=None):
         callbacks = []
-        for fix in self.fixes:
-            fix.apply(page, summaries, callbacks)
+        # views of the text are shared by the fixes until it changes
+        document = WikitextDocument(page)
+        for fix in self.fixes if fixes is None else fixes:
+            old_text = page.text
+            fix.document = document
+            try:
+                fix.apply(page, summaries, callbacks)
+            finally:
+                fix.document = None
+            if changed is not None and page.text != old_text:
+                changed.append(fix.key)
         return callbacks
 
     def userPut(self, page, oldtext, newtext, **kwargs):
@@ -95,6 +220,114 @@ class WikitextFixingBot(SingleSiteBot, ExistingPageBot):
         page.save(*args, **kwargs)
 
 
+_pipeline_state = {}  # set in each worker process
+
+
+def _init_pipeline_worker(bot, fixes):
+    _pipeline_state.update(bot=bot, fixes=fixes)
+    # connections of the parent process cannot be shared
+    session = requests.Session()
+    session.cookies = http.session.cookies
+    http.session = session
+    for fix in fixes:
+        fix.prepare_worker()
+
+
+def _apply_fixes(title, text):
+    bot = _pipeline_state['bot']
+    page = pywikibot.Page(bot.site, title)
+    page.text = text
+    summaries = []
+    bot.applyFixes(page, summaries, _pipeline_state['fixes'])
+    return page.text, summaries
+
+
+def _dry_run_page(title, text):
+    bot = _pipeline_state['bot']
+    page = pywikibot.Page(bot.site, title)
+    page.text = text
+    changed = []
+    bot.applyFixes(page, [], _pipeline_state['fixes'], changed)
+    if not changed:
+        return title, changed, ''
+    diff = ''.join(difflib.unified_diff(
+        text.splitlines(keepends=True), page.text.splitlines(keepends=True),
+        f'a/{title}', f'b/{title}'))
+    return title, changed, diff
+
+
+def iter_dump_pages(path):
+    for entry in XmlDump(path).parse():
+        if entry.ns == '0' and not entry.isredirect:
+            yield entry.title, entry.text
+
+
+def iter_directory_pages(path):
+    '''Yield titles and texts of files in the directory tree'''
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            filename = os.path.join(root, name)
+            title = os.path.splitext(os.path.relpath(filename, path))[0]
+            with open(filename, encoding='utf-8') as file:
+                yield title.replace(os.sep, '/').replace('_', ' '), file.read()
+
+
+def dry_run(bot, pages, output, batch=100):
+    '''
+    Apply the fixes of the bot to local pages without saving anything
+
+    Unified diffs of changed pages are written to changes.diff in the
+    output directory, numbers of pages changed by each fix to
+    stats.json. Only fixes which need nothing but the text can run,
+    so nothing is requested from the wiki while the pages are fixed.
+    '''
+    online = [fix.key for fix in bot.fixes if not fix.parallel]
+    if online:
+        pywikibot.error(f"Cannot run {', '.join(online)} offline")
+        return None
+    if fork_context() is None:
+        pywikibot.error('Worker processes cannot be forked here')
+        return None
+
+    config.simulate = True  # no page.save, whatever happens
+    processes = bot.opt.processes
+    if not processes or processes is True:
+        processes = multiprocessing.cpu_count()
+    os.makedirs(output, exist_ok=True)
+    stats = {'pages': 0, 'changed': 0,
+             'fixes': {fix.key: 0 for fix in bot.fixes}}
+
+    def record(title, changed, diff):
+        stats['pages'] += 1
+        if changed:
+            stats['changed'] += 1
+            for key in changed:
+                stats['fixes'][key] += 1
+            diffs.write(diff)
+
+    executor = bot.start_workers(bot.fixes, processes)
+    with open(os.path.join(output, 'changes.diff'), 'w',
+              encoding='utf-8') as diffs:
+        try:
+            for group in itergroup(pages, batch * processes):
+                titles, texts = zip(*group)
+                for result in executor.map(
+                        _dry_run_page, titles, texts, chunksize=8):
+                    record(*result)
+        finally:
+            # the results of map() cancel the rest once dropped
+            executor.shutdown()
+
+    with open(os.path.join(output, 'stats.json'), 'w',
+              encoding='utf-8') as file:
+        json.dump(stats, file, ensure_ascii=False, indent=1)
+    pywikibot.info(f"{stats['changed']} of {stats['pages']} pages changed")
+    for key, count in stats['fixes'].items():
+        pywikibot.info(f'{key}: {count}')
+    return stats
+
+
 def main(*args):
     options = {}
     local_args = pywikibot.handle_args(args)
@@ -107,6 +340,27 @@ def main(*args):
             else:
                 options[arg[1:]] = True
 
+    xml = options.pop('xml', None)
+    directory = options.pop('dir', None)
+    if xml or directory:
+        output = options.pop('dryrun', True)
+        if output is True:
+            output = 'dryrun'
+        # refuse before any fix is constructed and loads its data
+        online = [fix for fix, cls
+                  in WikitextFixingBot.demanded_fixes(options).items()
+                  if not cls.parallel]
+        if options.get('all', False) is True:
+            options.update(dict.fromkeys(online, True))  # excluded
+        elif online:
+            pywikibot.error(f"Cannot run {', '.join(online)} offline")
+            return
+        bot = WikitextFixingBot(generator=[], **options)
+        pages = iter_dump_pages(xml) if xml else iter_directory_pages(
+            directory)
+        dry_run(bot, pages, output)
+        return
+
     generator = genFactory.getCombinedGenerator(preload=True)
     bot = WikitextFixingBot(generator=generator, **options)
     bot.run()
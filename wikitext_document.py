@@ -0,0 +1,88 @@
+import re
+
+import mwparserfromhell
+
+from pywikibot import textlib
+
+
+# headers of level 2 and more, also those with unbalanced equal signs
+header_regex = re.compile(
+    r'^(?P<start>==+)(?P<content>((?!==|= *$).)+?)(?P<end>==+) *$', re.M)
+
+
+class WikitextDocument:
+
+    '''
+    Text of a page with views of it computed on demand
+
+    Each view is computed once and kept until the page text changes,
+    so fixes which leave the text as it is share the views. They must
+    not be modified unless the fix changes the page text afterwards.
+    '''
+
+    views = {
+        'categories': lambda site, text: textlib.getCategoryLinks(
+            text, site=site),
+        'headers': lambda site, text: list(header_regex.finditer(text)),
+        'templates': lambda site, text:
+            textlib.extract_templates_and_params(text, strip=True),
+        'tree': lambda site, text: mwparserfromhell.parse(
+            text, skip_style_tags=True),
+    }
+
+    def __init__(self, page):
+        self.page = page
+        self.site = page.site
+        self.version = 0  # increased when the text changes
+        self._text = page.text
+        self._views = {}
+
+    def sync(self):
+        '''Drop the views if the page text was changed'''
+        text = self.page.text
+        if text is not self._text and text != self._text:
+            self._text = text
+            self._views.clear()
+            self.version += 1
+
+    @property
+    def text(self):
+        self.sync()
+        return self._text
+
+    def get(self, view, text=None):
+        '''
+        Return the view of the current page text
+
+        :param text: text to make the view of instead, it is only
+            cached when it is the same as the page text
+        '''
+        self.sync()
+        if text is not None and text is not self._text and text != self._text:
+            return self.views[view](self.site, text)
+        if view not in self._views:
+            self._views[view] = self.views[view](self.site, self._text)
+        return self._views[view]
+
+    @property
+    def categories(self):
+        return self.get('categories')
+
+    @property
+    def headers(self):
+        return self.get('headers')
+
+    @property
+    def templates(self):
+        return self.get('templates')
+
+    @property
+    def tree(self):
+        return self.get('tree')
+
+
+def get_view(document, view, text, site):
+    '''Return the view of the text, shared by the document if there is one'''
+    if document is not None:
+        return document.get(view, text)
+    return WikitextDocument.views[view](site, text)